@@ -0,0 +1,309 @@
+"""
+Benchmarks for the pgtt generator hot paths.
+
+Run from the scripts directory:
+
+    python3 bench.py                          # micro benchmarks
+    python3 bench.py pipeline -o bench.json   # pipeline suite, JSON baseline
+    python3 bench.py pipeline --baseline bench.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from pgtt.mmu import MemAttr, MmuConfig, Region
+from pgtt.table import Table
+from pgtt.codegen import CodeGen
+from pgtt.batch import generate_all
+
+
+class BenchConfig:
+    """
+    Minimal stand-in for PgtConfig describing a synthetic memory map.
+    """
+    def __init__(self, tg_str, tsz, regions, large_page=False, el=1, ttbr=0x80000000):
+        self.ttbr_str       = hex(ttbr)
+        self.ttbr           = ttbr
+        self.el             = el
+        self.tg_str         = tg_str
+        self.tg             = {"4K": 4*1024, "16K": 16*1024, "64K": 64*1024}[tg_str]
+        self.tsz            = tsz
+        self.large_page     = large_page
+        self.gen_code       = True
+        self.contiguous_hint = False
+        self.runtime_fill   = "code"
+        self.zero_tables    = "all"
+        self.table_image    = None
+        self.parallel_cpus  = 0
+        self.table_jobs     = 1
+        self.dedupe_tables  = False
+        self.stage          = 1
+        self.address_spaces = []
+        self.regions        = regions
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def populated_table(tg_str, num_entries, one_run=True):
+    """
+    Build a map whose single level 3 table has its first num_entries entries
+    populated, either as one contiguous run or as num_entries separate runs
+    with alternating attributes.
+    """
+    tg = {"4K": 4*1024, "16K": 16*1024, "64K": 64*1024}[tg_str]
+    if one_run:
+        regions = [Region(0, "RAM", 0, 0, num_entries * tg, "NORMAL", MemAttr(1, 0, 0))]
+    else:
+        regions = [
+            Region(0, f"WIN{i}", i * tg, i * tg, tg, "NORMAL" if i % 2 else "DEVICE_nGnRE", MemAttr(1, 0, 0))
+            for i in range(num_entries)
+        ]
+    mmu_conf = MmuConfig(BenchConfig(tg_str, 32, regions))
+    return Table.gen(mmu_conf.start_level, mmu_conf)
+
+
+def bench_walk():
+    """
+    Time the per-table run walk and both back ends over fully and partially
+    populated 4K, 16K and 64K level 3 tables.
+    The cost per entry stays flat as the table fills up if the walk is linear.
+    """
+    print(f"{'granule':>8} {'entries':>8} {'runs':>6} {'walk ms':>9} {'asm ms':>9} {'mem ms':>9} {'ns/entry':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        image = os.path.join(tmp, "page")
+        for tg_str, entries_per_table in (("4K", 512), ("16K", 2048), ("64K", 8192)):
+            for one_run in (True, False):
+                for num_entries in (entries_per_table // 4, entries_per_table // 2, entries_per_table):
+                    root = populated_table(tg_str, num_entries, one_run)
+                    leaf = root.allocator.tables[-1]
+                    coder = CodeGen(root)
+                    walk = _timed(lambda: list(leaf.runs()))
+                    asm = _timed(coder._mk_asm)
+                    mem = _timed(coder._mk_mem, image)
+                    print(f"{tg_str:>8} {num_entries:>8} {len(list(leaf.runs())):>6} "
+                          f"{walk * 1e3:>9.3f} {asm * 1e3:>9.3f} {mem * 1e3:>9.3f} "
+                          f"{(walk + asm + mem) * 1e9 / num_entries:>9.0f}")
+
+
+def bench_batch(num_configs=16):
+    """
+    Compare serial and process-pool generation of independent pagetable configs.
+    """
+    regions = lambda i: [Region(0, "RAM", i << 30, 1 << 30, 256 << 20, "NORMAL", MemAttr(1, 0, 0))]
+    confs = [BenchConfig(tg_str, 48, regions(i)) for i in range(num_configs // 2) for tg_str in ("4K", "16K")]
+    serial = _timed(generate_all, confs, 1)
+    parallel = _timed(generate_all, confs)
+    print(f"{len(confs)} configs: serial {serial:.2f}s, parallel ({os.cpu_count()} cpus) {parallel:.2f}s")
+
+
+GRANULES = {"4K": 4*1024, "16K": 16*1024, "64K": 64*1024}
+STAGES = ("parse", "table", "asm", "mem", "gen")
+
+
+def synthetic_pagetable(num_regions, tg_str, tsz, large_page, seed=0):
+    """
+    Build a config.json "pagetables" entry with num_regions windows spread
+    evenly over the 2^tsz input address space, or None if they do not fit.
+
+    Most windows are a few pages long; every 16th one is a few MB so large
+    pages have something to map as blocks. Output addresses keep a fixed
+    offset from the input addresses, aligned to 1GB.
+    """
+    tg = GRANULES[tg_str]
+    stride = ((1 << tsz) // num_regions) // tg * tg
+    if stride < 2 * tg:
+        return None
+    rand = random.Random(seed)
+    maps = []
+    for i in range(num_regions):
+        pages = rand.randint(1, 16) if i % 16 else rand.randint(256, 1024)
+        pages = min(pages, stride // tg // 2)
+        va = i * stride + rand.randrange(0, stride // 2, tg)
+        maps.append({
+            "va": hex(va),
+            "pa": hex(va + (1 << 30)),
+            "size": f"{pages * tg // 1024}K",
+            "type": "NORMAL" if i % 3 else "DEVICE_nGnRE",
+            "attr": "wxs",
+            "description": f"WIN{i}",
+        })
+    return {
+        "gen_table_runtime" : True,
+        "excepiton_level"   : 1,
+        "table_base_addr"   : "0x80000000",
+        "granule"           : tg_str,
+        "table_region_size" : tsz,
+        "large_page"        : large_page,
+        "maps"              : maps,
+    }
+
+
+def _config_parser():
+    """
+    Return the config.json parser to time, config.PgtConfig.
+    """
+    from config import PgtConfig
+    return PgtConfig
+
+
+def _run_pipeline(pgt, parser, image):
+    """
+    Run every stage once, returning (seconds per stage, number of tables).
+    """
+    times = {}
+    start = time.perf_counter()
+    pgt_conf = parser(pgt)
+    times["parse"] = time.perf_counter() - start
+    mmu_conf = MmuConfig(pgt_conf)
+    start = time.perf_counter()
+    root = Table.gen(mmu_conf.start_level, mmu_conf)
+    times["table"] = time.perf_counter() - start
+    coder = CodeGen(root)
+    times["asm"] = _timed(coder._mk_asm)
+    times["mem"] = _timed(coder._mk_mem, image)
+    times["gen"] = _timed(coder.gen, image)
+    return times, len(root.allocator)
+
+
+def _peak_memory(pgt, parser, image):
+    """
+    Peak traced allocation in bytes of the whole pipeline for one config.
+    """
+    tracemalloc.start()
+    try:
+        pgt_conf = parser(pgt)
+        mmu_conf = MmuConfig(pgt_conf)
+        CodeGen(Table.gen(mmu_conf.start_level, mmu_conf)).gen(image)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_pipeline(sizes, granules, tszs, large_pages, repeat=1, memory=True):
+    """
+    Time each pipeline stage over synthetic maps of every combination of
+    region count, granule, tsz and large_page, keeping the best of repeat
+    runs. Returns one result dict per combination that fits.
+    """
+    parser = _config_parser()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        image = os.path.join(tmp, "page")
+        for num_regions in sizes:
+            for tg_str in granules:
+                for tsz in tszs:
+                    for large_page in large_pages:
+                        pgt = synthetic_pagetable(num_regions, tg_str, tsz, large_page)
+                        if pgt is None:
+                            continue
+                        runs = [_run_pipeline(pgt, parser, image) for _ in range(repeat)]
+                        times = {
+                            stage: min(r[0][stage] for r in runs)
+                            for stage in STAGES
+                        }
+                        result = {
+                            "name": f"{num_regions}/{tg_str}/{tsz}/{large_page}",
+                            "regions": num_regions,
+                            "granule": tg_str,
+                            "tsz": tsz,
+                            "large_page": large_page,
+                            "tables": runs[0][1],
+                            "seconds": times,
+                            "peak_bytes": _peak_memory(pgt, parser, image) if memory else None,
+                        }
+                        results.append(result)
+                        print(_format(result), flush=True)
+    return results
+
+
+def _format(result):
+    cols = " ".join(
+        f"{'-':>9}" if t is None else f"{t * 1e3:>9.1f}"
+        for t in (result["seconds"][stage] for stage in STAGES)
+    )
+    peak = "-" if result["peak_bytes"] is None else f"{result['peak_bytes'] / 2**20:.1f}"
+    return f"{result['name']:>24} {result['tables']:>7} {cols} {peak:>9}"
+
+
+def compare(results, baseline, tolerance, min_seconds=0.005, min_bytes=64 * 1024):
+    """
+    Return a description of every stage timing or peak memory that grew by
+    more than tolerance (a ratio, e.g. 0.2 for 20%) over the baseline.
+
+    Growth under min_seconds or min_bytes is ignored whatever the ratio, as
+    sub-millisecond stages are dominated by timer and scheduling noise.
+    """
+    previous = {r["name"]: r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(result["name"])
+        if old is None:
+            continue
+        metrics = [(f"{stage} s", result["seconds"][stage], old["seconds"].get(stage), min_seconds) for stage in STAGES]
+        metrics.append(("peak bytes", result["peak_bytes"], old.get("peak_bytes"), min_bytes))
+        for metric, new_value, old_value, floor in metrics:
+            if (new_value is not None and old_value and new_value > old_value * (1 + tolerance)
+                    and new_value - old_value >= floor):
+                regressions.append(f"{result['name']} {metric}: {old_value:.4g} -> {new_value:.4g}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest="suite")
+    sub.add_parser("micro", help="per-table walk and batch benchmarks")
+    pipeline = sub.add_parser("pipeline", help="timed and memory-profiled pipeline over synthetic maps")
+    pipeline.add_argument("--sizes", default="10,100,1000,10000,100000",
+                          help="comma separated region counts")
+    pipeline.add_argument("--granules", default="4K,16K,64K")
+    pipeline.add_argument("--tsz", default="32,36,40,48")
+    pipeline.add_argument("--large-page", default="true,false",
+                          help='comma separated large_page values: true, false, auto')
+    pipeline.add_argument("--repeat", type=int, default=1, help="keep the best of N runs")
+    pipeline.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    pipeline.add_argument("-o", "--output", help="write results to this JSON file")
+    pipeline.add_argument("--baseline", help="compare against a JSON file written by --output")
+    pipeline.add_argument("--tolerance", type=float, default=0.25,
+                          help="relative slowdown reported as a regression")
+    pipeline.add_argument("--min-ms", type=float, default=5,
+                          help="ignore slowdowns of a stage under this many milliseconds")
+    args = parser.parse_args(argv)
+
+    if args.suite != "pipeline":
+        bench_walk()
+        bench_batch()
+        return 0
+
+    large_pages = [{"true": True, "false": False}.get(v, v) for v in args.large_page.split(",")]
+    print(f"{'config':>24} {'tables':>7} " + " ".join(f"{s + ' ms':>9}" for s in STAGES) + f" {'peak MB':>9}")
+    results = bench_pipeline(
+        [int(n) for n in args.sizes.split(",")],
+        args.granules.split(","),
+        [int(n) for n in args.tsz.split(",")],
+        large_pages,
+        args.repeat,
+        not args.no_memory,
+    )
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump({"python": sys.version.split()[0], "results": results}, fd, indent=1)
+    if args.baseline:
+        with open(args.baseline) as fd:
+            regressions = compare(results, json.load(fd), args.tolerance, args.min_ms / 1000)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,108 +1,378 @@
+"""
+Generate pagetables and mmu_on code from config.json.
+
+Importing this module has no side effects; the command line lives in main().
+The pgtt generator modules are imported by the commands that need them, so
+the register and table count commands never load the code generator.
+"""
+import argparse
 import errno
 import re
 import sys
 import logging
 import json
+from functools import lru_cache
+
+from pgtt.index import RegionIndex
+from pgtt.mmu import AddressSpace, MemAttr, MemType, MmuConfig, Region
+
+
+GRANULES = {"4K": 4*1024, "16K": 16*1024, "64K": 64*1024}
+MEM_TYPES = {t.name for t in MemType}
+
+_SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+_ATTR = re.compile(r"(!?)w(!?)x(!?)s")
+_STRING = re.compile(r'"[^"\\\n]*(?:\\.[^"\\\n]*)*"')
+_COMMENT = re.compile(r"//|/\*")
+
+
+class ConfigError(ValueError):
+    """
+    Raised for a config file that cannot be parsed or has invalid values.
+    """
+
+
+def _in_string( text:str, start:int, end:int ) -> int:
+    """
+    If offset end lies inside a string literal that starts at or after
+    offset start on the same line, return the offset just past that string
+    (or the end of the line for an unterminated one), else return -1.
+    JSON strings cannot span lines.
+    """
+    i = text.find('"', start, end)
+    while i >= 0:
+        m = _STRING.match(text, i)
+        if not m:
+            line_end = text.find("\n", end)
+            return len(text) if line_end < 0 else line_end
+        if m.end() > end:
+            return m.end()
+        i = text.find('"', m.end(), end)
+    return -1
+
+
+def strip_comments( text:str ) -> str:
+    """
+    Remove // and /* */ comments, including ones trailing JSON on the same
+    line, in a single forward pass. Only the text before each comment marker
+    on its line is scanned for strings, so comment markers inside strings
+    (e.g. URLs) are kept. Newlines are kept so json reports errors at the
+    right line.
+    """
+    parts = []
+    pos = 0
+    m = _COMMENT.search(text)
+    while m:
+        start = m.start()
+        skip = _in_string(text, max(pos, text.rfind("\n", 0, start) + 1), start)
+        if skip >= 0:
+            m = _COMMENT.search(text, skip)
+            continue
+        parts.append(text[pos:start])
+        if m.group() == "//":
+            end = text.find("\n", start)
+            end = len(text) if end < 0 else end
+        else:
+            end = text.find("*/", start + 2)
+            end = len(text) if end < 0 else end + 2
+            parts.append("\n" * text.count("\n", start, end))
+        pos = end
+        m = _COMMENT.search(text, pos)
+    parts.append(text[pos:])
+    return "".join(parts)
+
 
-from pgtt.mmu import *
-from pgtt.table import *
-from pgtt.codegen import *
+@lru_cache(maxsize=None)
+def _parse_attr( s:str ) -> MemAttr:
+    m = _ATTR.fullmatch(s) if isinstance(s, str) else None
+    if not m:
+        raise ConfigError(f"bad memory attr {s!r}, expected [!]w[!]x[!]s")
+    # force enable EL0 access
+    ap = 0b11 if m.group(1) else 0b01
+    xn = 0b1  if m.group(2) else 0b0
+    ns = 0b1  if m.group(3) else 0b0
+    return MemAttr(ap, xn, ns)
+
+
+def _is_large_page( v ) -> bool:
+    # identity, as 0 and 1 compare equal to False and True
+    return v is True or v is False or v == "auto"
 
 
 class PgtConfig:
-    def __init__(self, pgt):
+    def __init__(self, pgt, name="pagetable"):
+        """
+        Constructor.
+
+        args
+        ====
+
+            pgt
+                        one entry of the config's "pagetables" list
+
+            name
+                        how errors refer to this entry, e.g. pagetables[0]
+
+        All invalid maps are reported together in a single ConfigError.
+        Regions from "maps_file", a binary or CSV memory map (see
+        pgtt.mapfile), are appended to those of "maps".
+        """
         self.logger         = logging.getLogger(type(self).__name__)
         self.logger.setLevel(logging.ERROR)
 
-        self.ttbr_str       = pgt["table_base_addr"]
-        self.ttbr           = self.parse_addr(pgt["table_base_addr"])
-        self.el             = pgt["excepiton_level"]
-        self.tg_str         = pgt["granule"]
-        self.tg             = {"4K": 4*1024, "16K": 16*1024, "64K": 64*1024}[self.tg_str]
-        self.tsz            = pgt["table_region_size"]
-        self.large_page     = pgt["large_page"]
-        self.gen_code       = pgt["gen_table_runtime"]
-
-        self.regions = []
-        for idx, pgt_map in enumerate(pgt["maps"]):
-            va = self.parse_addr(pgt_map["va"])
-            pa = self.parse_addr(pgt_map["pa"])
-            size = self.parse_size(pgt_map["size"])
-            # alignment adjust
-            down_alignment = va % self.tg
-            up_alignment = (va + size) % self.tg
-            up_alignment = 0 if not up_alignment else self.tg - up_alignment
-            size += (down_alignment + up_alignment)
-
-            mem_type = pgt_map["type"]
-            mem_attr = self.parse_attr(pgt_map["attr"])
-            label = pgt_map["description"]
-            r = Region(0, label, va, pa, size, mem_type, mem_attr)
-            self.regions.append(r)
+        try:
+            self.ttbr_str       = pgt["table_base_addr"]
+            self.ttbr           = self.parse_addr(pgt["table_base_addr"])
+            self.el             = pgt["excepiton_level"]
+            self.tg_str         = pgt["granule"]
+            self.tsz            = pgt["table_region_size"]
+            self.large_page     = pgt["large_page"]
+            self.gen_code       = pgt["gen_table_runtime"]
+            maps                = pgt["maps"] if "maps_file" not in pgt else pgt.get("maps", [])
+        except KeyError as e:
+            raise ConfigError(f"{name}: missing {e}") from None
+        except ConfigError as e:
+            raise ConfigError(f"{name}: {e}") from None
+        if self.tg_str not in GRANULES:
+            raise ConfigError(f"{name}: granule '{self.tg_str}' is not one of {', '.join(GRANULES)}")
+        if self.tsz not in (32, 36, 40, 48):
+            raise ConfigError(f"{name}: table_region_size {self.tsz} is not one of 32, 36, 40, 48")
+        if self.el not in (1, 2, 3):
+            raise ConfigError(f"{name}: excepiton_level {self.el} is not one of 1, 2, 3")
+        if not _is_large_page(self.large_page):
+            raise ConfigError(f"{name}: large_page {self.large_page!r} is not one of true, false, \"auto\"")
+        if not isinstance(self.gen_code, bool):
+            raise ConfigError(f"{name}: gen_table_runtime {self.gen_code!r} is not true or false")
+        self.tg             = GRANULES[self.tg_str]
+        self.contiguous_hint = pgt.get("contiguous_hint", False)
+        if not isinstance(self.contiguous_hint, bool):
+            raise ConfigError(f"{name}: contiguous_hint {self.contiguous_hint!r} is not true or false")
+        self.runtime_fill   = pgt.get("runtime_fill", "code")
+        if self.runtime_fill not in ("code", "table"):
+            raise ConfigError(f"{name}: runtime_fill {self.runtime_fill!r} is not one of \"code\", \"table\"")
+        self.zero_tables    = pgt.get("zero_tables", "all")
+        if self.zero_tables not in ("all", "sparse", "none"):
+            raise ConfigError(f"{name}: zero_tables {self.zero_tables!r} is not one of \"all\", \"sparse\", \"none\"")
+        self.table_image    = pgt.get("table_image")
+        if self.table_image is not None and not isinstance(self.table_image, str):
+            raise ConfigError(f"{name}: table_image {self.table_image!r} is not a file name")
+        self.parallel_cpus  = pgt.get("parallel_cpus", 0)
+        if not isinstance(self.parallel_cpus, int) or not 0 <= self.parallel_cpus <= 256:
+            raise ConfigError(f"{name}: parallel_cpus {self.parallel_cpus!r} is not a number of CPUs from 0 to 256")
+        self.table_jobs     = pgt.get("table_jobs", 1)
+        if not isinstance(self.table_jobs, int) or self.table_jobs < 0:
+            raise ConfigError(f"{name}: table_jobs {self.table_jobs!r} is not a number of processes, or 0 for one per CPU")
+        self.dedupe_tables  = pgt.get("dedupe_tables", False)
+        if not isinstance(self.dedupe_tables, bool):
+            raise ConfigError(f"{name}: dedupe_tables {self.dedupe_tables!r} is not true or false")
+        self.stage          = pgt.get("stage", 1)
+        if self.stage not in (1, 2):
+            raise ConfigError(f"{name}: stage {self.stage!r} is not one of 1, 2")
+        if self.stage == 2:
+            if self.el == 1:
+                raise ConfigError(f"{name}: stage 2 tables are programmed from excepiton_level 2 or 3")
+            root_size = MmuConfig(self).root_tables * self.tg
+            if self.ttbr % root_size:
+                raise ConfigError(f"{name}: table_base_addr {self.ttbr_str} is not aligned to the {hex(root_size)} bytes of the stage 2 initial tables")
+
+        errors = []
+        self.regions = self.parse_maps(maps, f"{name}.maps", errors)
+        self.address_spaces = []
+        for n, space in enumerate(pgt.get("address_spaces", [])):
+            where = f"{name}.address_spaces[{n}]"
+            asid = space.get("asid") if isinstance(space, dict) else None
+            if not isinstance(asid, int) or not 0 <= asid <= 255:
+                raise ConfigError(f"{where}: asid {asid!r} is not an 8-bit ASID")
+            if asid in (s.asid for s in self.address_spaces):
+                raise ConfigError(f"{where}: asid {asid} is used by another address space")
+            regions = [r.copy(non_global=True) for r in self.parse_maps(space.get("maps", []), f"{where}.maps", errors)]
+            self.address_spaces.append(AddressSpace(asid, space.get("description", f"asid{asid}"), regions))
+        if self.address_spaces and (self.stage != 1 or self.el != 1):
+            raise ConfigError(f"{name}: address_spaces need stage 1 tables at excepiton_level 1, where TTBR0 holds the ASID")
+        if errors:
+            shown = errors[:20] + ([f"... and {len(errors) - 20} more"] if len(errors) > 20 else [])
+            raise ConfigError(f"{len(errors)} invalid maps:\n    " + "\n    ".join(shown))
+
+        if "maps_file" in pgt:
+            if not isinstance(pgt["maps_file"], str):
+                raise ConfigError(f"{name}: maps_file {pgt['maps_file']!r} is not a file name")
+            from pgtt.mapfile import read_map_file
+            try:
+                file_regions = read_map_file(pgt["maps_file"], self.tg)
+            except (ValueError, OSError) as e:
+                raise ConfigError(f"{name}.maps_file: {e}") from None
+            for r in file_regions:
+                if r.va + r.size > 1 << self.tsz:
+                    raise ConfigError(f"{name}.maps_file: region '{r.label}' {hex(r.va)}-{hex(r.va + r.size - 1)} is beyond table_region_size {self.tsz}")
+            self.regions += file_regions
+
+        # overlapping maps that disagree are rejected here rather than by Table.gen
+        spaces = [(f"{name}.address_spaces[{n}]", s.regions) for n, s in enumerate(self.address_spaces)]
+        for where, extra in spaces or [(f"{name}.maps", [])]:
+            try:
+                RegionIndex(self.regions + extra)
+            except ValueError as e:
+                raise ConfigError(f"{where}: {e}") from None
+
+    def parse_maps(self, maps, where, errors):
+        """
+        Parse a list of maps, appending a message for each invalid one to
+        errors instead of stopping at the first.
+        """
+        regions = []
+        for idx, pgt_map in enumerate(maps):
+            try:
+                regions.append(self.parse_map(pgt_map))
+            except KeyError as e:
+                errors.append(f"{where}[{idx}]: missing {e}")
+            except (ConfigError, TypeError) as e:
+                errors.append(f"{where}[{idx}] ({pgt_map.get('description', '?') if isinstance(pgt_map, dict) else pgt_map!r}): {e}")
+        return regions
+
+    def parse_map(self, pgt_map):
+        va = self.parse_addr(pgt_map["va"])
+        pa = self.parse_addr(pgt_map["pa"])
+        size = self.parse_size(pgt_map["size"])
+        if va + size > 1 << self.tsz:
+            raise ConfigError(f"{hex(va)}-{hex(va + size - 1)} is beyond table_region_size {self.tsz}")
+        # alignment adjust
+        down_alignment = va % self.tg
+        up_alignment = (va + size) % self.tg
+        up_alignment = 0 if not up_alignment else self.tg - up_alignment
+        size += (down_alignment + up_alignment)
+
+        mem_type = pgt_map["type"]
+        if mem_type not in MEM_TYPES:
+            raise ConfigError(f"unknown memory type '{mem_type}'")
+        mem_attr = self.parse_attr(pgt_map["attr"])
+        label = pgt_map["description"]
+        large_page = pgt_map.get("large_page")
+        if large_page is not None and not _is_large_page(large_page):
+            raise ConfigError(f"large_page {large_page!r} is not one of true, false, \"auto\"")
+        return Region(0, label, va, pa, size, mem_type, mem_attr, large_page)
 
     def parse_addr(self, s):
-        s = s.upper()
         try:
-            addr = int(s, base=(16 if s.startswith("0X") else 10))
-        except ValueError:
-            self.logger.error(f"invalid config address {s}")
-        return addr
+            return int(s, 16 if s[:2] in ("0x", "0X") else 10)
+        except (ValueError, TypeError):
+            raise ConfigError(f"invalid address {s!r}") from None
 
     def parse_size(self, s):
-        s = s.upper()
-        x = re.search(r"(\d+)([KMGT])", s)
         try:
-            qty = x.group(1)
-            self.logger.debug(f"got qty: {qty}")
-            unit = x.group(2)
-            self.logger.debug(f"got unit: {unit}")
-        except AttributeError:
-            self.logger.error(f"invalid config size {s}")
-        return int(qty) * 1024 ** ("KMGT".find(unit) + 1)
+            if s[:-1].isdigit():
+                return int(s[:-1]) * _SIZE_UNITS[s[-1].upper()]
+        except (KeyError, TypeError, AttributeError):
+            pass
+        raise ConfigError(f"invalid size {s!r}, expected a number followed by K, M, G or T")
 
     def parse_attr(self, s):
-        if re.match(r"(^!?w!?x!?s$)", s):
-            self.logger.error(f"bad memory attr {s}")
-            sys.exit(errno.EINVAL)
-        # force enable EL0 access
-        ap = 0b11 if re.search(r"!w", s) else 0b01
-        xn = 0b1  if re.search(r"!x", s) else 0b0
-        ns = 0b1  if re.search(r"!s", s) else 0b0
-
-        return MemAttr(ap, xn, ns)
+        return _parse_attr(s)
 
 class Config:
     def __init__(self, config_file_raw):
+        self.config_file = config_file_raw
         self.config_str = self.remove_comments(config_file_raw)
-        self.config = json.loads(self.config_str)
-
-    def is_comment_line(self, line):
-        if re.match(r"\s*//.*", line):
-            return True
-        return False
+        try:
+            self.config = json.loads(self.config_str)
+        except json.JSONDecodeError as e:
+            raise ConfigError(f"{config_file_raw}:{e.lineno}:{e.colno}: {e.msg}") from None
 
     def remove_comments(self, config_file_raw):
-        lines = ""
         with open(config_file_raw, "r") as config_raw_handle:
-            lines_raw = config_raw_handle.readlines()
-            for line in lines_raw:
-                if not self.is_comment_line(line):
-                    lines += line
+            return strip_comments(config_raw_handle.read())
 
-        return lines
     def pgt_configs(self):
-        pgt_configs = []
-        for pg in self.config["pagetables"]:
-            pgt_configs.append(PgtConfig(pg))
-        return pgt_configs
-
-
-logging.basicConfig( level=logging.DEBUG)
-conf = Config("config.json")
-print(conf.pgt_configs())
-for pgt_conf in conf.pgt_configs():
-    mmu_conf = MmuConfig(pgt_conf)
-    table = Table.gen(mmu_conf.start_level, mmu_conf)
-    print(str(table))
-    coder = CodeGen(table)
-    print(coder.gen())
+        try:
+            pagetables = self.config["pagetables"]
+        except (KeyError, TypeError):
+            raise ConfigError(f"{self.config_file}: missing \"pagetables\" list") from None
+        return [PgtConfig(pg, f"pagetables[{n}]") for n, pg in enumerate(pagetables)]
+
+
+def load( config_file="config.json" ):
+    """
+    Parse config_file and return one PgtConfig per pagetables entry.
+    """
+    return Config(config_file).pgt_configs()
+
+
+def generate( pgt_confs, jobs=None, cache_dir=".pgtt-cache" ):
+    """
+    Generate the artifacts of each PgtConfig, reusing cached ones when
+    cache_dir is set.
+    """
+    from pgtt.batch import generate_all
+    from pgtt.cache import ArtifactCache
+    cache = ArtifactCache(cache_dir) if cache_dir else None
+    return generate_all(pgt_confs, jobs, cache)
+
+
+def cmd_gen( args, pgt_confs ):
+    if args.no_cache or not args.cache_dir:
+        # nothing to store, stream straight to stdout
+        from pgtt.batch import stream_all
+        stream_all(pgt_confs, sys.stdout, args.jobs)
+        return 0
+    artifacts = generate(pgt_confs, args.jobs, args.cache_dir)
+    for artifact in artifacts:
+        print(artifact.dump)
+        print(artifact.usage)
+        print(artifact.asm)
+    for pgt_conf, artifact in zip(pgt_confs, artifacts):
+        if pgt_conf.table_image:
+            with open(pgt_conf.table_image, "wb") as page_mem_fd:
+                page_mem_fd.write(artifact.image)
+    return 0
+
+
+def cmd_regs( args, pgt_confs ):
+    for n, pgt_conf in enumerate(pgt_confs):
+        mmu_conf = MmuConfig(pgt_conf)
+        el = pgt_conf.el
+        if pgt_conf.stage == 2:
+            print(f"pagetable {n}: vttbr_el2={hex(pgt_conf.ttbr)} vtcr_el2={mmu_conf.vtcr} hcr_el2.vm=1")
+            continue
+        ttbr0 = pgt_conf.ttbr
+        if pgt_conf.address_spaces:
+            ttbr0 |= pgt_conf.address_spaces[0].asid << 48     # first space, the others are in mmu_spaces
+        print(f"pagetable {n}: ttbr0_el{el}={hex(ttbr0)} tcr_el{el}={mmu_conf.tcr} "
+              f"mair_el{el}={mmu_conf.mair} sctlr_el{el}={mmu_conf.sctlr}")
+    return 0
+
+
+def cmd_count( args, pgt_confs ):
+    from pgtt.table import count_tables
+    for n, pgt_conf in enumerate(pgt_confs):
+        num_tables = count_tables(MmuConfig(pgt_conf))
+        shared = " before sharing identical tables" if pgt_conf.dedupe_tables else ""
+        print(f"pagetable {n}: {num_tables} tables, {hex(num_tables * pgt_conf.tg)} bytes{shared}")
+    return 0
+
+
+COMMANDS = {
+    "gen":      cmd_gen,        # tables, code and images (default)
+    "regs":     cmd_regs,       # TTBR/TCR/MAIR/SCTLR values only
+    "count":    cmd_count,      # number of tables, without building them
+}
+
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser(description="Generate AArch64 pagetables and mmu_on code.")
+    parser.add_argument("command", nargs="?", default="gen", choices=COMMANDS)
+    parser.add_argument("-c", "--config", default="config.json", help="JSON config with // comments")
+    parser.add_argument("-j", "--jobs", type=int, help="worker processes for gen (default: one per CPU)")
+    parser.add_argument("--cache-dir", default=".pgtt-cache", help="artifact cache used by gen")
+    parser.add_argument("--no-cache", action="store_true", help="always regenerate")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig( level=logging.DEBUG)
+    try:
+        pgt_confs = load(args.config)
+    except (ConfigError, OSError) as e:
+        logging.getLogger("Config").error(e)
+        return errno.EINVAL
+    return COMMANDS[args.command](args, pgt_confs)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,7 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+__version__ = "0.2.2"
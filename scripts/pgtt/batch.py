@@ -0,0 +1,153 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List
+import io
+import os
+import shutil
+import tempfile
+
+# Internal deps
+from .mmu import MmuConfig
+from .table import Table
+from .codegen import CodeGen
+
+
+@dataclass
+class Artifact:
+    """
+    Class holding everything generated for one pagetable config.
+    """
+
+    asm: str                     # mmu_on assembly
+    image: bytes                 # translation table memory image
+    dump: str                    # pretty-printed table tree
+    num_tables: int              # number of allocated translation tables
+    usage: str = ""              # table memory usage summary
+
+
+def _build( pgt_conf ) -> CodeGen:
+    """
+    Build the translation tables for a single pagetable config.
+    """
+    mmu_conf = MmuConfig(pgt_conf)
+    roots = None
+    if pgt_conf.address_spaces:
+        roots = Table.gen_spaces(mmu_conf.start_level, mmu_conf, pgt_conf.table_jobs)
+        table = roots[0]
+    else:
+        table = Table.gen(mmu_conf.start_level, mmu_conf, pgt_conf.table_jobs)
+    if pgt_conf.dedupe_tables:
+        table.dedupe()
+    return CodeGen(table, roots)
+
+
+def _dump( coder:CodeGen, fd ) -> None:
+    """
+    Stream the table dump, one tree per address space, to an open text file.
+    """
+    if coder.roots is None:
+        coder.table.dump(fd)
+        return
+    for space, root in zip(coder.pgt_conf.address_spaces, coder.roots):
+        fd.write(f"address space {space.label} (ASID {space.asid}):\n")
+        root.dump(fd)
+
+
+def generate( pgt_conf ) -> Artifact:
+    """
+    Run the whole pipeline for a single pagetable config.
+    """
+    coder = _build(pgt_conf)
+    dump = io.StringIO()
+    _dump(coder, dump)
+    return Artifact(
+        asm=coder.gen(None),
+        image=coder.image(),
+        dump=dump.getvalue(),
+        num_tables=len(coder.table.allocator),
+        usage=coder.table.allocator.usage(),
+    )
+
+
+def stream( pgt_conf, fd ) -> None:
+    """
+    Run the whole pipeline for a single pagetable config, streaming the table
+    dump, usage summary and assembly to an open text file instead of building
+    them as strings, and writing the table image to table_image if set.
+    """
+    coder = _build(pgt_conf)
+    _dump(coder, fd)
+    fd.write("\n")
+    fd.write(coder.table.allocator.usage())
+    fd.write("\n")
+    coder.write(fd)
+    fd.write("\n")
+    if pgt_conf.table_image:
+        with open(pgt_conf.table_image, "wb") as page_mem_fd:
+            page_mem_fd.write(coder.image())
+
+
+def _stream_file( pgt_conf, path:str ) -> str:
+    with open(path, "w") as fd:
+        stream(pgt_conf, fd)
+    return path
+
+
+def generate_all( pgt_confs, jobs:int=None, cache=None ) -> List[Artifact]:
+    """
+    Generate the artifacts for several pagetable configs.
+
+    Configs are independent, so they are fanned out to a process pool of
+    `jobs` workers (default: one per CPU). Artifacts are returned in the same
+    order as pgt_confs regardless of which worker finishes first. A single
+    config or jobs=1 runs in-process to avoid the pool start-up cost.
+
+    When an ArtifactCache is given, only configs missing from it are generated
+    and the new artifacts are stored back into it.
+    """
+    pgt_confs = list(pgt_confs)
+    artifacts = [cache.get(c) if cache else None for c in pgt_confs]
+    misses = [i for i, a in enumerate(artifacts) if a is None]
+
+    jobs = min(jobs or os.cpu_count() or 1, len(misses))
+    if jobs <= 1:
+        generated = [generate(pgt_confs[i]) for i in misses]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            generated = list(pool.map(generate, [pgt_confs[i] for i in misses]))
+
+    for i, artifact in zip(misses, generated):
+        artifacts[i] = artifact
+        if cache:
+            cache.put(pgt_confs[i], artifact)
+    return artifacts
+
+
+def stream_all( pgt_confs, fd, jobs:int=None ) -> None:
+    """
+    Stream the output of several pagetable configs to an open text file, in
+    the same order as pgt_confs.
+
+    As in generate_all, configs are fanned out to `jobs` worker processes.
+    Each worker streams to a temporary file that is copied to fd as soon as
+    it and those before it are done, so no output is held in memory.
+    """
+    pgt_confs = list(pgt_confs)
+    jobs = min(jobs or os.cpu_count() or 1, len(pgt_confs))
+    if jobs <= 1:
+        for pgt_conf in pgt_confs:
+            stream(pgt_conf, fd)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp, ProcessPoolExecutor(max_workers=jobs) as pool:
+        paths = [os.path.join(tmp, f"{n}.txt") for n in range(len(pgt_confs))]
+        for path in pool.map(_stream_file, pgt_confs, paths):
+            with open(path, "r") as out:
+                shutil.copyfileobj(out, fd)
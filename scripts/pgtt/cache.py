@@ -0,0 +1,153 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+from functools import lru_cache
+from typing import Optional
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+# Internal deps
+from . import __version__
+from .batch import Artifact
+
+
+@lru_cache(maxsize=None)
+def _sources_digest() -> str:
+    """
+    Hash of the pgtt sources, so entries made by a modified generator are
+    never returned even when __version__ was not bumped along with it.
+    """
+    sources = hashlib.sha256()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(package_dir)):
+        if name.endswith(".py"):
+            sources.update(name.encode())
+            with open(os.path.join(package_dir, name), "rb") as f:
+                sources.update(f.read())
+    return sources.hexdigest()
+
+
+def _region_fields( r ) -> tuple:
+    return (r.lineno, r.label, r.va, r.pa, r.size, str(r.mem_type),
+            r.mem_attr.ap, r.mem_attr.xn, r.mem_attr.ns, r.large_page, r.non_global)
+
+
+class ArtifactCache:
+    """
+    Content-addressed on-disk cache of generated pagetable artifacts.
+
+    Entries are keyed on a hash of the normalized pagetable config and the
+    tool version and sources, and stored as one directory per key holding the
+    assembly, the table image, the table dump, the usage summary and the
+    number of tables. The least recently used entries are evicted once the
+    cache grows beyond max_bytes.
+    """
+    ASM = "mmu_on.S"
+    IMAGE = "page.bin"
+    DUMP = "tables.txt"
+    USAGE = "usage.txt"
+    NUM_TABLES = "num_tables.txt"
+
+
+    def __init__( self, cache_dir:str, max_bytes:int=256 * 1024 * 1024 ):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    @staticmethod
+    def key( pgt_conf ) -> str:
+        """
+        Hash of everything in pgt_conf that affects the generated artifacts.
+        """
+        fields = {k: v for k, v in vars(pgt_conf).items() if k not in ("logger", "regions", "address_spaces", "table_image")}
+        fields["regions"] = [_region_fields(r) for r in pgt_conf.regions]
+        fields["address_spaces"] = [
+            (s.asid, s.label, [_region_fields(r) for r in s.regions])
+            for s in pgt_conf.address_spaces
+        ]
+        fields["version"] = __version__
+        fields["sources"] = _sources_digest()
+        normalized = json.dumps(fields, sort_keys=True, default=repr)
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+    def get( self, pgt_conf ) -> Optional[Artifact]:
+        """
+        Return the cached artifact for pgt_conf, or None on a miss.
+        """
+        entry = os.path.join(self.cache_dir, self.key(pgt_conf))
+        try:
+            with open(os.path.join(entry, self.ASM), "r") as f:
+                asm = f.read()
+            with open(os.path.join(entry, self.IMAGE), "rb") as f:
+                image = f.read()
+            with open(os.path.join(entry, self.DUMP), "r") as f:
+                dump = f.read()
+            with open(os.path.join(entry, self.USAGE), "r") as f:
+                usage = f.read()
+            with open(os.path.join(entry, self.NUM_TABLES), "r") as f:
+                num_tables = int(f.read())
+        except FileNotFoundError:
+            self.logger.debug(f"miss {entry}")
+            return None
+        os.utime(entry)
+        self.logger.debug(f"hit {entry}")
+        return Artifact(asm=asm, image=image, dump=dump, num_tables=num_tables, usage=usage)
+
+
+    def put( self, pgt_conf, artifact:Artifact ) -> None:
+        """
+        Store the artifact generated for pgt_conf, then evict old entries.
+        The entry is written to a temporary directory first so readers never
+        see a partial entry.
+        """
+        entry = os.path.join(self.cache_dir, self.key(pgt_conf))
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-")
+        with open(os.path.join(tmp, self.ASM), "w") as f:
+            f.write(artifact.asm)
+        with open(os.path.join(tmp, self.IMAGE), "wb") as f:
+            f.write(artifact.image)
+        with open(os.path.join(tmp, self.DUMP), "w") as f:
+            f.write(artifact.dump)
+        with open(os.path.join(tmp, self.USAGE), "w") as f:
+            f.write(artifact.usage)
+        with open(os.path.join(tmp, self.NUM_TABLES), "w") as f:
+            f.write(str(artifact.num_tables))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # another process stored the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+
+    def evict( self ) -> None:
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, path))
+            total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.logger.debug(f"evicting {path}")
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -3,7 +3,17 @@ Copyright (c) 2019 Ash Wilding. All rights reserved.
 
 SPDX-License-Identifier: MIT
 """
+from array import array
 from struct import *
+import io
+import mmap
+import sys
+
+# Optional deps
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Internal deps
 from .mmu import *
@@ -12,8 +22,25 @@ from .table import *
 
 
 class CodeGen:
-    def __init__(self, table):
+    def __init__(self, table, roots=None):
+        """
+        Constructor.
+
+        args
+        ====
+
+            table
+                        root translation table; every table of its allocator
+                        is zeroed, filled and written to the image
+
+            roots
+                        roots of the address spaces from Table.gen_spaces,
+                        in pgt_conf.address_spaces order, or None for one
+                        space with table as its root
+
+        """
         self.table = table
+        self.roots = roots
         self.pgt_conf = table.pgt_conf
         self.mmu_conf = table.mmu_conf
 
@@ -64,7 +91,7 @@ class CodeGen:
         LDR     x10, ={entry_idx_start}                 // idx
         LDR     x11, ={region.num_contig}        // number of contiguous entries
         LDR     x12, ={hex(region.pa)}         // output address of entry[idx]
-        LDR     x13, ={self.mmu_conf.entry_template(region.mem_type, region.mem_attr, region.is_page)}
+        LDR     x13, ={self.mmu_conf.entry_template(region.mem_type, region.mem_attr, region.is_page, region.contiguous, region.non_global)}
     1:
         ORR     x12, x12, x13    // merge output address with template
         STR     X12, [x8, x10, lsl #3]      // write entry into table
@@ -102,69 +129,627 @@ class CodeGen:
 
 
 
+    def _run_records(self):
+        """
+        Describe every run of entries as a (table_addr, idx, count, pa,
+        template, chunk) record; a next-level table pointer is a run of one
+        entry whose output address is the next-level table.
+        """
+        for t in self.table.allocator:
+            for idx, entry, run_length in t.runs():
+                if type(entry) is Run:
+                    template = self.mmu_conf.entry_template_value(entry.mem_type, entry.mem_attr, entry.is_page, entry.contiguous, entry.non_global)
+                    yield (t.addr, idx, run_length, entry.pa, template, t.chunk)
+                else:
+                    yield (t.addr, idx, 1, entry.addr, 0x3, 0)
+
+
+    def _iter_run_table(self):
+        """
+        Generate a .rodata table of descriptor runs and the single loop that
+        programs all of them, instead of one stanza per run.
+        """
+        yield """
+
+        .pushsection .rodata.mmu
+        .balign 8
+
+    mmu_runs:                               // table_addr, idx, count, pa, template, chunk
+"""
+        for record in self._run_records():
+            yield f"        .8byte  {', '.join(hex(x) for x in record)}\n"
+        yield """
+    mmu_runs_end:
+
+        .popsection
+
+    program_tables:
+
+        ADRP    x4, mmu_runs                // get 4KB page containing mmu_runs
+        ADD     x4, x4, :lo12:mmu_runs      // restore low 12 bits lost by ADRP
+        ADRP    x5, mmu_runs_end
+        ADD     x5, x5, :lo12:mmu_runs_end"""
+        yield self._run_loop()
+
+
+    @staticmethod
+    def _run_loop() -> str:
+        """
+        Loop programming the run records in [x4, x5).
+        """
+        return """
+    1:
+        CMP     x4, x5                      // all runs programmed?
+        B.HS    3f
+        LDP     x8, x10, [x4], #16          // table address, idx
+        LDP     x11, x12, [x4], #16         // number of entries, output address of entry[idx]
+        LDP     x13, x9, [x4], #16          // template, chunk size
+        ADD     x8, x8, x10, lsl #3         // address of entry[idx]
+    2:
+        ORR     x14, x12, x13               // merge output address with template
+        STR     x14, [x8], #8               // write entry into table
+        ADD     x12, x12, x9                // add chunk to address
+        SUBS    x11, x11, #1                // loop as required
+        B.NE    2b
+        B       1b
+    3:"""
+
+
+    def _zero_ranges(self):
+        """
+        Yield the (address, length) byte ranges of all table entries not
+        covered by any run, merging gaps that span adjacent tables.
+        """
+        gap_start = self.pgt_conf.ttbr
+        for t in self.table.allocator:
+            for idx, _, run_length in t.runs():
+                run_start = t.addr + idx * 8
+                if run_start > gap_start:
+                    yield (gap_start, run_start - gap_start)
+                gap_start = run_start + run_length * 8
+        end = self.pgt_conf.ttbr + self.table.allocator.size()
+        if end > gap_start:
+            yield (gap_start, end - gap_start)
+
+
+    def _iter_zero(self):
+        """
+        Generate assembly to clear the table memory before it is programmed.
+
+        zero_tables selects:
+
+            "all"       clear every table in one pass
+            "sparse"    clear only the entries no run will program
+            "none"      clear nothing, the table image is preloaded
+        """
+        if self.pgt_conf.zero_tables == "none":
+            yield """
+                                            // tables are preloaded, nothing to clear"""
+            return
+
+        if self.pgt_conf.zero_tables == "all":
+            yield f"""
+        LDR     x2, ={hex(self.pgt_conf.ttbr)}        // address of first table
+        LDR     x3, ={hex(self.table.allocator.size())}   // combined length of all tables
+        LSR     x3, x3, #5                  // number of required STP instructions
+        FMOV    d0, xzr                     // clear q0
+    1:
+        STP     q0, q0, [x2], #32           // zero out 4 table entries at a time
+        SUBS    x3, x3, #1
+        B.NE    1b"""
+            return
+
+        yield """
+        .pushsection .rodata.mmu
+        .balign 8
+
+    mmu_gaps:                               // address, length in bytes
+"""
+        for gap in self._zero_ranges():
+            yield f"        .8byte  {hex(gap[0])}, {hex(gap[1])}\n"
+        yield """
+    mmu_gaps_end:
+
+        .popsection
+
+        ADRP    x4, mmu_gaps                // get 4KB page containing mmu_gaps
+        ADD     x4, x4, :lo12:mmu_gaps      // restore low 12 bits lost by ADRP
+        ADRP    x5, mmu_gaps_end
+        ADD     x5, x5, :lo12:mmu_gaps_end"""
+        yield self._gap_loop()
+
+
+    @staticmethod
+    def _gap_loop() -> str:
+        """
+        Loop clearing the (address, length) gap records in [x4, x5).
+        """
+        return """
+        FMOV    d0, xzr                     // clear q0
+    1:
+        CMP     x4, x5                      // all gaps cleared?
+        B.HS    5f
+        LDP     x2, x3, [x4], #16           // gap address, length in bytes
+    2:
+        CBZ     x3, 1b                      // gap cleared
+        TST     x2, #0x1f
+        B.EQ    3f                          // aligned for STP
+        STR     xzr, [x2], #8               // zero out 1 table entry
+        SUB     x3, x3, #8
+        B       2b
+    3:
+        CMP     x3, #32
+        B.LO    4f
+        STP     q0, q0, [x2], #32           // zero out 4 table entries at a time
+        SUB     x3, x3, #32
+        B       3b
+    4:
+        CBZ     x3, 1b                      // gap cleared
+        STR     xzr, [x2], #8               // zero out 1 table entry
+        SUB     x3, x3, #8
+        B       4b
+    5:"""
+
+
+    def _iter_asm(self):
+        """
+        Generate assembly to program all allocated translation tables, one
+        table or run at a time.
+        """
+        if self.pgt_conf.runtime_fill == "table":
+            yield from self._iter_run_table()
+            return
+
+        for n,t in enumerate(self.table.allocator):
+            yield self._mk_table(n, t)
+            for idx, entry, _ in t.runs():
+                if type(entry) is Run:
+                    yield self._mk_blocks(n, t, idx, entry)
+                else:
+                    yield self._mk_next_level_table(n, idx, entry)
+
+
     def _mk_asm(self) -> str:
         """
         Generate assembly to program all allocated translation tables.
         """
-        string = ""
-        for n,t in enumerate(self.table._allocated):
-            string += self._mk_table(n, t)
-            keys = sorted(list(t.entries.keys()))
-            while keys:
-                idx = keys[0]
-                entry = t.entries[idx]
-                if type(entry) is Region:
-                    string += self._mk_blocks(n, t, idx, entry)
-                    for k in range(idx, idx+entry.num_contig):
-                        keys.remove(k)
-                else:
-                    string += self._mk_next_level_table(n, idx, entry)
-                    keys.remove(idx)
-        return string
-
-    def _fill_entry(self, table, entry_idx, entry, page_mem_fd):
-        entry_offset = table.addr - self.pgt_conf.ttbr + entry_idx * 8
-        page_mem_fd.seek(entry_offset)
-        if type(entry) is Region:
-            for idx in range(entry_idx, entry_idx + entry.num_contig):
-                addr = entry.pa + (idx - entry_idx) * table.chunk + int(self.mmu_conf.entry_template(entry.mem_type, entry.mem_attr, entry.is_page), base=16)
-                data = pack("<Q", addr)
-                page_mem_fd.write(data)
+        return "".join(self._iter_asm())
+
+    def _fill_entry(self, table, entry_idx, entry, entries) -> None:
+        """
+        Fill the descriptors of one run into entries, a memoryview of the
+        image cast to native uint64, with a single slice assignment.
+        """
+        start = (table.addr - self.pgt_conf.ttbr) // 8 + entry_idx
+        if type(entry) is Run:
+            template = self.mmu_conf.entry_template_value(entry.mem_type, entry.mem_attr, entry.is_page, entry.contiguous, entry.non_global)
+            first = entry.pa + template
+            entries[start:start + entry.num_contig] = array("Q", range(first, first + entry.num_contig * table.chunk, table.chunk))
+        else:
+            entries[start] = entry.addr | 0x3
+
 
+    def _fill_entry_packed(self, table, entry_idx, entry, buf) -> None:
+        """
+        Pack the little-endian descriptors of one run into buf, for hosts
+        where a native uint64 view of the image is not little-endian.
+        """
+        offset = table.addr - self.pgt_conf.ttbr + entry_idx * 8
+        if type(entry) is Run:
+            template = self.mmu_conf.entry_template_value(entry.mem_type, entry.mem_attr, entry.is_page, entry.contiguous, entry.non_global)
+            for idx in range(entry.num_contig):
+                pack_into("<Q", buf, offset + idx * 8, entry.pa + idx * table.chunk + template)
         else:
-            addr = (entry.addr | 0x3)
-            data = pack("<Q", addr )
-            page_mem_fd.write(data)
+            pack_into("<Q", buf, offset, entry.addr | 0x3)
+
 
+    def _fill_table(self, table, image) -> None:
+        """
+        Fill the uint64 descriptors of a table into its slice of image.
+        Each contiguous run is produced with a single vectorized operation.
+        """
+        base = (table.addr - self.pgt_conf.ttbr) // 8
+        for idx, entry, run_length in table.runs():
+            if type(entry) is Run:
+                template = self.mmu_conf.entry_template_value(entry.mem_type, entry.mem_attr, entry.is_page, entry.contiguous, entry.non_global)
+                start = base + idx
+                image[start:start + run_length] = (
+                    numpy.arange(run_length, dtype=numpy.uint64) * numpy.uint64(table.chunk)
+                    + numpy.uint64(entry.pa + template)
+                )
+            else:
+                image[base + idx] = entry.addr | 0x3
 
 
-    def _mk_mem(self, page_mem_file) :
+    def _fill_image(self, buf) -> None:
         """
-        Generate assembly to program all allocated translation tables.
+        Fill the descriptors of all allocated tables into buf, a zeroed
+        writable buffer of allocator.size() bytes in which each table lives at
+        offset table.addr - ttbr. No I/O happens while filling.
+        """
+        if numpy is not None:
+            image = numpy.frombuffer(buf, dtype="<u8")
+            for t in self.table.allocator:
+                self._fill_table(t, image)
+            del image
+        elif sys.byteorder == "little":
+            with memoryview(buf) as view, view.cast("Q") as entries:
+                for t in self.table.allocator:
+                    for idx, entry, _ in t.runs():
+                        self._fill_entry(t, idx, entry, entries)
+        else:
+            for t in self.table.allocator:
+                for idx, entry, _ in t.runs():
+                    self._fill_entry_packed(t, idx, entry, buf)
+
+
+    def _write_mem(self, page_mem_fd) -> None:
+        """
+        Write the memory image of all allocated translation tables to an
+        open binary file object.
+        """
+        page_mem_fd.write(self.image())
+
+
+    def _mk_mem(self, page_mem_file, sparse:bool=True) :
+        """
+        Generate the memory image of all allocated translation tables.
+
+        With sparse set the file is sized up front and filled in place through
+        mmap, so runs of untouched zero pages are left as file holes on
+        filesystems that support them.
+        """
+        size = self.table.allocator.size()
+        if not sparse:
+            with open(page_mem_file, "wb") as page_mem_fd:
+                self._write_mem(page_mem_fd)
+            return
+
+        with open(page_mem_file, "w+b") as page_mem_fd:
+            page_mem_fd.truncate(size)
+            with mmap.mmap(page_mem_fd.fileno(), size) as buf:
+                self._fill_image(buf)
+
+
+    def image(self) -> bytearray:
+        """
+        Return the memory image of all allocated translation tables.
+        """
+        buf = bytearray(self.table.allocator.size())
+        self._fill_image(buf)
+        return buf
+
+
+    def _table_values(self, table) -> dict:
+        """
+        Map the index of every populated entry of a table to its descriptor.
+        """
+        values = {}
+        for idx, entry, run_length in table.runs():
+            if type(entry) is Run:
+                template = self.mmu_conf.entry_template_value(entry.mem_type, entry.mem_attr, entry.is_page, entry.contiguous, entry.non_global)
+                for k in range(run_length):
+                    values[idx + k] = entry.pa + k * table.chunk + template
+            else:
+                values[idx] = entry.addr | 0x3
+        return values
+
+
+    def _patch_levels(self) -> list:
+        """
+        Group the changed entries returned by patches() by table level,
+        deepest level first.
+        """
+        levels = {}
+        for t, indices in sorted(self.table.allocator.dirty.items(), key=lambda d: (-d[0].level, d[0].addr)):
+            values = self._table_values(t)
+            levels.setdefault(t.level, []).extend((t.addr + idx * 8, values.get(idx, 0)) for idx in sorted(indices))
+        return list(levels.values())
+
+
+    def patches(self):
+        """
+        Return the (address, descriptor) of every entry changed since the
+        allocator's dirty set was last cleared, 0 for entries that were
+        unmapped. Entries of deeper tables come first, so that when each
+        level is made visible before the next is written, as mmu_patch does,
+        a new next-level table is complete before the descriptor pointing to
+        it can be walked.
+        """
+        return [patch for level in self._patch_levels() for patch in level]
+
+
+    def patch_image(self, image) -> bytearray:
+        """
+        Apply the changed descriptors to a previously generated table image,
+        growing it with zeroed tables if new ones were allocated.
+        """
+        image = bytearray(image)
+        image.extend(bytes(self.table.allocator.size() - len(image)))
+        for addr, value in self.patches():
+            pack_into("<Q", image, addr - self.pgt_conf.ttbr, value)
+        return image
+
+
+    def _iter_patch(self):
+        """
+        Generate mmu_patch, a function applying the changed descriptors to
+        live translation tables with break-before-make: every changed entry
+        is first invalidated and the TLBs flushed before the new descriptors
+        are written.
+        """
+        tlbi = {1: "VMALLE1IS", 2: "ALLE2IS", 3: "ALLE3IS"}[self.pgt_conf.el]
+        if self.pgt_conf.stage == 2:
+            tlbi = "VMALLS12E1IS"       # stage 2 and combined stage 1+2 entries of the VMID
+        yield """
+        .section .rodata.mmu_patch
+        .balign 8
+
+    mmu_patches:                            // address, descriptor
+"""
+        for n, level in enumerate(self._patch_levels()):
+            if n:
+                yield "        .8byte  0, 0                // next level\n"
+            for addr, value in level:
+                yield f"        .8byte  {hex(addr)}, {hex(value)}\n"
+        yield f"""
+    mmu_patches_end:
+
+        .section .text.mmu_patch
+        .balign 4
+        .global mmu_patch
+        .type mmu_patch, @function
+
+    mmu_patch:
+
+        ADRP    x0, mmu_patches
+        ADD     x0, x0, :lo12:mmu_patches
+        ADRP    x1, mmu_patches_end
+        ADD     x1, x1, :lo12:mmu_patches_end
+        MOV     x2, x0
+    1:
+        CMP     x2, x1                      // break: invalidate every changed entry
+        B.HS    2f
+        LDR     x3, [x2], #16               // entry address
+        CBZ     x3, 1b                      // skip level separator
+        STR     xzr, [x3]
+        B       1b
+    2:
+        DSB     ISHST                       // invalid entries visible to the walker
+        TLBI    {tlbi}                    // drop stale translations
+        DSB     ISH
+    3:
+        CMP     x0, x1                      // make: write the new descriptors
+        B.HS    4f
+        LDP     x3, x4, [x0], #16           // entry address, descriptor
+        CBZ     x3, 5f
+        STR     x4, [x3]
+        B       3b
+    5:
+        DSB     ISHST                       // deeper level complete before entries pointing to it
+        B       3b
+    4:
+        DSB     ISH
+        ISB
+        RET
+"""
+
+
+    def gen_patch(self) -> str:
+        """
+        Generate the mmu_patch assembly, see _iter_patch.
+        """
+        output = io.StringIO()
+        self.write(output, self._iter_patch())
+        return output.getvalue()
+
+
+    @staticmethod
+    def _split_evenly(items, n:int, weight, split) -> list:
+        """
+        Cut items, kept in order, into n consecutive slices of about equal
+        total weight. An item straddling a slice boundary is cut in two with
+        split(item, head_weight), which returns the (head, tail) items.
+        """
+        total = sum(weight(item) for item in items)
+        slices = [[] for _ in range(n)]
+        k = 0
+        filled = 0
+        for item in items:
+            while True:
+                limit = (k + 1) * total // n
+                if k == n - 1 or filled + weight(item) <= limit:
+                    slices[k].append(item)
+                    filled += weight(item)
+                    break
+                if limit > filled:
+                    head, item = split(item, limit - filled)
+                    slices[k].append(head)
+                    filled = limit
+                k += 1
+        return slices
+
+
+    def _parallel_runs(self) -> list:
+        """
+        Split the run records into one slice per CPU with about the same
+        number of entries to write each.
+        """
+        def split(record, count):
+            addr, idx, run_length, pa, template, chunk = record
+            return ((addr, idx, count, pa, template, chunk),
+                    (addr, idx + count, run_length - count, pa + count * chunk, template, chunk))
+        return self._split_evenly(list(self._run_records()), self.pgt_conf.parallel_cpus, lambda r: r[2], split)
+
+
+    def _parallel_zero_ranges(self) -> list:
+        """
+        Split the byte ranges to clear into one slice per CPU, cutting them
+        at 32-byte (STP) boundaries for "all" and at entries for "sparse".
+        """
+        if self.pgt_conf.zero_tables == "all":
+            ranges, unit = [(self.pgt_conf.ttbr, self.table.allocator.size())], 32
+        else:
+            ranges, unit = list(self._zero_ranges()), 8
+        def split(gap, units):
+            return (gap[0], units * unit), (gap[0] + units * unit, gap[1] - units * unit)
+        return self._split_evenly(ranges, self.pgt_conf.parallel_cpus, lambda g: g[1] // unit, split)
+
+
+    @staticmethod
+    def _iter_sliced_records(name:str, comment:str, slices:list):
+        """
+        Generate a .rodata array of records, all of CPU 0's slice first, and
+        a name_slices array giving the [start, end) byte offsets of each
+        CPU's records from name.
+        """
+        yield f"""
+        .pushsection .rodata.mmu
+        .balign 8
+
+    {name}:                               // {comment}
+"""
+        offsets = []
+        offset = 0
+        for records in slices:
+            offsets.append((offset, offset + len(records) * len(records[0]) * 8 if records else offset))
+            for record in records:
+                yield f"        .8byte  {', '.join(hex(x) for x in record)}\n"
+            offset = offsets[-1][1]
+        yield f"""
+    {name}_slices:                        // per CPU: first and end record offset
+"""
+        for start, end in offsets:
+            yield f"        .8byte  {hex(start)}, {hex(end)}\n"
+        yield f"""
+        .popsection
+
+        ADRP    x4, {name}_slices
+        ADD     x4, x4, :lo12:{name}_slices
+        ADD     x4, x4, x6, lsl #4          // this CPU's slice
+        LDP     x2, x3, [x4]                // first and end record offset
+        ADRP    x4, {name}                  // get 4KB page containing {name}
+        ADD     x4, x4, :lo12:{name}        // restore low 12 bits lost by ADRP
+        ADD     x5, x4, x3
+        ADD     x4, x4, x2"""
+
+
+    def _iter_parallel_zero(self):
+        """
+        Generate assembly clearing this CPU's slice of the table memory.
+        """
+        if self.pgt_conf.zero_tables == "none":
+            yield """
+                                            // tables are preloaded, nothing to clear"""
+            return
+
+        slices = self._parallel_zero_ranges()
+        if self.pgt_conf.zero_tables == "sparse":
+            yield from self._iter_sliced_records("mmu_gaps", "address, length in bytes", slices)
+            yield self._gap_loop()
+            return
+
+        yield """
+        .pushsection .rodata.mmu
+        .balign 8
+
+    mmu_zero_slices:                        // per CPU: address, length in bytes
+"""
+        for records in slices:
+            address, length = records[0] if records else (self.pgt_conf.ttbr, 0)
+            yield f"        .8byte  {hex(address)}, {hex(length)}\n"
+        yield """
+        .popsection
+
+        ADRP    x4, mmu_zero_slices
+        ADD     x4, x4, :lo12:mmu_zero_slices
+        ADD     x4, x4, x6, lsl #4          // this CPU's slice
+        LDP     x2, x3, [x4]                // address, length in bytes
+        LSR     x3, x3, #5                  // number of required STP instructions
+        FMOV    d0, xzr                     // clear q0
+        CBZ     x3, 2f                      // empty slice
+    1:
+        STP     q0, q0, [x2], #32           // zero out 4 table entries at a time
+        SUBS    x3, x3, #1
+        B.NE    1b
+    2:"""
+
+
+    def _iter_parallel_fill(self):
         """
-        #page_data = bytearray()
-        with open(page_mem_file, "wb") as page_mem_fd:
-
-            page_mem_fd.write(b'\x00' * self.pgt_conf.tg * len(self.table._allocated))
-
-            for n,t in enumerate(self.table._allocated):
-                keys = sorted(list(t.entries.keys()))
-                while keys:
-                    idx = keys[0]
-                    entry = t.entries[idx]
-                    if type(entry) is Region:
-                        self._fill_entry(t, idx, entry, page_mem_fd)
-                        for k in range(idx, idx+entry.num_contig):
-                            keys.remove(k)
-                    else:
-                        self._fill_entry(t, idx, entry, page_mem_fd)
-                        keys.remove(idx)
-
-        page_mem_fd.close()
-
-    def gen(self):
-        _newline = "\n"
-        _tmp = f"""
+        Generate assembly programming this CPU's slice of the run records.
+        """
+        yield from self._iter_sliced_records(
+            "mmu_runs", "table_addr, idx, count, pa, template, chunk", self._parallel_runs()
+        )
+        yield self._run_loop()
+
+
+    @staticmethod
+    def _barrier(target:int) -> str:
+        """
+        Count this CPU into mmu_count then wait until target arrivals.
+        The release/acquire pair orders each CPU's table writes before any
+        CPU continues past the barrier.
+        """
+        return f"""
+    6:
+        LDAXR   w2, [x0]                    // read mmu_count
+        ADD     w2, w2, #1
+        STLXR   w3, w2, [x0]                // count this CPU in
+        CBNZ    w3, 6b
+        SEV                                 // wake CPUs waiting at the barrier
+    7:
+        CMP     w2, #{target}
+        B.HS    8f                          // everyone has arrived
+        WFE
+        LDAXR   w2, [x0]                    // read mmu_count
+        B       7b
+    8:"""
+
+
+    def _iter_parallel(self):
+        """
+        Generate the body of mmu_on for parallel_cpus: every CPU below that
+        core position clears and then programs its own slice of the tables,
+        with a barrier after each phase instead of mmu_lock.
+        """
+        cpus = self.pgt_conf.parallel_cpus
+        phases = 0
+        yield from self._iter_parallel_zero()
+        if self.pgt_conf.zero_tables != "none":
+            phases += 1
+            if self.pgt_conf.gen_code:
+                yield "\n"
+                yield self._barrier(phases * cpus)
+        if self.pgt_conf.gen_code:
+            yield """
+
+    program_tables:
+"""
+            yield from self._iter_parallel_fill()
+            phases += 1
+        yield "\n"
+        yield self._barrier(phases * cpus) if phases else ""
+        yield """
+
+    init_done:
+
+        DSB     ISH                         // tables visible to every CPU's walks
+        MOV     w2, #INITIALISED
+        STLR    w2, [x1]                    // release CPUs beyond parallel_cpus
+
+    end:
+"""
+        yield self._mk_program_regs()
+        yield self._mk_return()
+
+
+    def _mk_header(self) -> str:
+        """
+        Generate the comment block at the top of the generated file.
+        """
+        return """
     /*
      * This file was automatically generated using arm64-pgtable-tool.
      * See: https://github.com/ashwio/arm64-pgtable-tool
@@ -180,23 +765,51 @@ class CodeGen:
      * The programmer must also ensure that the virtual memory region containing the
      * translation tables is itself marked as NORMAL in the memory map file.
      */
+"""
 
-        .section .data.mmu
-        .balign 2
 
-        mmu_lock: .4byte 0                  // lock to ensure only 1 CPU runs init
+    def _mk_data(self, parallel:bool) -> str:
+        """
+        Generate the .data.mmu section: mmu_lock, or the mmu_count barrier
+        counter with parallel_cpus, followed by mmu_init.
+        """
+        if parallel:
+            sync = """        mmu_count: .4byte 0                 // arrivals at the init barriers
+"""
+        else:
+            sync = """        mmu_lock: .4byte 0                  // lock to ensure only 1 CPU runs init
         #define LOCKED 1
+"""
+        return """
+        .section .data.mmu
+        .balign 2
 
+""" + sync + """
         mmu_init: .4byte 0                  // whether init has been run
         #define INITIALISED 1
+"""
 
+
+    def _mk_text(self) -> str:
+        """
+        Generate the start of the mmu_on function.
+        """
+        return """
         .section .text.mmu_on
         .balign 2
         .global mmu_on
         .type mmu_on, @function
 
     mmu_on:
+"""
+
 
+    def _mk_lock_acquire(self) -> str:
+        """
+        Generate the serial entry to init: take mmu_lock, then skip to the end
+        if another CPU has already run init.
+        """
+        return """
         ADRP    x0, mmu_lock                // get 4KB page containing mmu_lock
         ADD     x0, x0, :lo12:mmu_lock      // restore low 12 bits lost by ADRP
         MOV     w1, #LOCKED
@@ -214,28 +827,42 @@ class CodeGen:
         ADD     x1, x1, :lo12:mmu_init      // restore low 12 bits lost by ADRP
         LDR     w2, [x1]                    // read mmu_init
         CBNZ    w2, end                     // init already done, skip to the end
+"""
 
-    zero_out_tables:
 
-        LDR     x2, ={hex(self.pgt_conf.ttbr)}        // address of first table
-        LDR     x3, ={hex(self.pgt_conf.tg * len(self.table._allocated))}   // combined length of all tables
-        LSR     x3, x3, #5                  // number of required STP instructions
-        FMOV    d0, xzr                     // clear q0
+    def _mk_parallel_entry(self) -> str:
+        """
+        Generate the parallel_cpus entry to init: CPUs below that core
+        position take a share of init, the others wait for mmu_init.
+        """
+        return f"""
+        MRS     x6, mpidr_el1               // core position, as plat_my_core_pos
+        AND     x6, x6, #0xff
+        ADRP    x0, mmu_count               // get 4KB page containing mmu_count
+        ADD     x0, x0, :lo12:mmu_count     // restore low 12 bits lost by ADRP
+        ADRP    x1, mmu_init                // get 4KB page containing mmu_init
+        ADD     x1, x1, :lo12:mmu_init      // restore low 12 bits lost by ADRP
+        LDAR    w2, [x1]                    // read mmu_init
+        CBNZ    w2, end                     // init already done, skip to the end
+        CMP     x6, #{self.pgt_conf.parallel_cpus}
+        B.LO    zero_out_tables             // this CPU takes a share of init
+        SEVL                                // first pass won't sleep
     1:
-        STP     q0, q0, [x2], #32           // zero out 4 table entries at a time
-        SUBS    x3, x3, #1
-        B.NE    1b
-
-    {self._mk_asm() if self.pgt_conf.gen_code else ""}
-
-    init_done:
-
-        MOV     w2, #INITIALISED
-        STR     w2, [x1]
+        WFE                                 // sleep on retry
+        LDAXR   w2, [x1]                    // read mmu_init
+        CBZ     w2, 1b                      // init not done, go back to sleep
+        B       end
+"""
 
-    end:
 
-        LDR     x1, ={self.pgt_conf.ttbr}             // program ttbr0 on this CPU
+    def _mk_program_regs(self) -> str:
+        """
+        Generate the register programming run by every CPU after init.
+        """
+        if self.pgt_conf.stage == 2:
+            return self._mk_s2_program_regs()
+        return f"""
+        LDR     x1, ={self._ttbr0(0)}             // program ttbr0 on this CPU
         MSR     ttbr0_el{self.pgt_conf.el}, x1
         LDR     x1, ={self.mmu_conf.mair}             // program mair on this CPU
         MSR     mair_el{self.pgt_conf.el}, x1
@@ -248,22 +875,174 @@ class CodeGen:
         LDR     x1, ={self.mmu_conf.sctlr}            // program sctlr on this CPU
         MSR     sctlr_el{self.pgt_conf.el}, x1
         ISB                                 // synchronize context on this CPU
-        STLR    wzr, [x0]                   // release mmu_lock
-        RET                                 // done!
+"""
+
+
+    def _mk_lock_release(self) -> str:
+        """
+        Generate the release of mmu_lock taken by _mk_lock_acquire.
+        """
+        return """        STLR    wzr, [x0]                   // release mmu_lock
+"""
+
+
+    def _mk_return(self) -> str:
+        """
+        Generate the return from mmu_on, followed by mmu_switch if any.
+        """
+        return """        RET                                 // done!
+    """ + self._mk_switch()
+
+
+    def _ttbr0(self, space:int) -> int:
+        """
+        TTBR0 value for an address space: its root table and, with
+        address spaces, its ASID in bits [63:48].
+        """
+        if not self.roots:
+            return self.pgt_conf.ttbr
+        return self.roots[space].addr | (self.pgt_conf.address_spaces[space].asid << 48)
+
+
+    def _mk_switch(self) -> str:
+        """
+        Generate mmu_switch, making the address space whose index is in x0
+        current on the calling CPU. Non-global TLB entries are tagged with
+        the ASID written along with the tables, and global ones are the same
+        in every space, so no TLB maintenance is needed.
+        """
+        if not self.roots:
+            return ""
+        spaces = "".join(
+            f"        .8byte  {hex(self._ttbr0(n))}             // {n}: ASID {space.asid}, {space.label}\n"
+            for n, space in enumerate(self.pgt_conf.address_spaces)
+        )
+        return f"""
+        .section .rodata.mmu
+        .balign 8
+
+    mmu_spaces:                             // ttbr0 value of each address space
+{spaces}
+        .section .text.mmu_switch
+        .balign 2
+        .global mmu_switch
+        .type mmu_switch, @function
+
+    mmu_switch:
+
+        ADRP    x1, mmu_spaces              // get 4KB page containing mmu_spaces
+        ADD     x1, x1, :lo12:mmu_spaces    // restore low 12 bits lost by ADRP
+        LDR     x1, [x1, x0, lsl #3]        // ttbr0 value of space x0
+        MSR     ttbr0_el{self.pgt_conf.el}, x1
+        ISB                                 // synchronize context on this CPU
+        RET
     """
 
 
+    def _mk_s2_program_regs(self) -> str:
+        """
+        Generate the register programming for stage 2: VTTBR_EL2 and
+        VTCR_EL2, then enable stage 2 translation with HCR_EL2.VM.
+        """
+        return f"""
+        LDR     x1, ={self.pgt_conf.ttbr}             // program vttbr (VMID 0) on this CPU
+        MSR     vttbr_el2, x1
+        LDR     x1, ={self.mmu_conf.vtcr}             // program vtcr on this CPU
+        MSR     vtcr_el2, x1
+        ISB
+        MRS     x2, vtcr_el2                // verify CPU supports desired config
+        CMP     x2, x1
+        B.NE    .
+        TLBI    VMALLS12E1                  // drop stale stage 1+2 entries for VMID 0
+        DSB     NSH
+        MRS     x1, hcr_el2                 // enable stage 2 on this CPU
+        ORR     x1, x1, #1                  // HCR_EL2.VM
+        MSR     hcr_el2, x1
+        ISB                                 // synchronize context on this CPU
+"""
+
+
+    def _iter_chunks(self):
+        """
+        Generate the whole mmu_on source as a stream of unaligned text chunks.
+        """
+        parallel = self.pgt_conf.parallel_cpus > 1
+        yield self._mk_header()
+        yield self._mk_data(parallel)
+        yield self._mk_text()
+        if parallel:
+            yield self._mk_parallel_entry()
+            yield "\n    zero_out_tables:\n"
+            yield from self._iter_parallel()
+            return
+
+        yield self._mk_lock_acquire()
+        yield "\n    zero_out_tables:\n"
+        yield from self._iter_zero()
+        yield "\n\n    "
+        if self.pgt_conf.gen_code:
+            yield from self._iter_asm()
+        yield """
+
+    init_done:
+
+        MOV     w2, #INITIALISED
+        STR     w2, [x1]
+
+    end:
+"""
+        yield self._mk_program_regs()
+        yield self._mk_lock_release()
+        yield self._mk_return()
+
+
+    @staticmethod
+    def _align(line:str) -> str:
+        """
+        Align the // comment of a line of assembly to a common column.
+        """
+        if "//" in line and not " * " in line:
+            idx = line.index("//")
+            code = line[:idx].rstrip()
+            comment = line[idx:]
+            line = f"{code}{' ' * (41 - len(code))}{comment}"
+        return line
+
+
+    def lines(self, chunks=None):
+        """
+        Generate the mmu_on assembly, or the assembly streamed by chunks, one
+        aligned line at a time, without ever holding the whole file in memory.
+        """
+        pending = ""
+        for chunk in self._iter_chunks() if chunks is None else chunks:
+            lines = (pending + chunk).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield self._align(line)
+        if pending:
+            yield self._align(pending)
 
-        output = ""
-        for line in _tmp.splitlines():
-            if "//" in line and not " * " in line:
-                idx = line.index("//")
-                code = line[:idx].rstrip()
-                comment = line[idx:]
-                line = f"{code}{' ' * (41 - len(code))}{comment}"
-            output += f"{line}\n"
 
-        self._mk_mem("/home/lh/page")
+    def write(self, asm_fd, chunks=None) -> None:
+        """
+        Stream the mmu_on assembly, or the assembly streamed by chunks, to an
+        open text file object.
+        """
+        for line in self.lines(chunks):
+            asm_fd.write(line)
+            asm_fd.write("\n")
+
+
+    def gen(self, page_mem_file=None):
+        """
+        Generate the mmu_on assembly, also writing the table memory image to
+        page_mem_file unless it is None.
+        """
+        output = io.StringIO()
+        self.write(output)
 
-        return output
+        if page_mem_file is not None:
+            self._mk_mem(page_mem_file)
 
+        return output.getvalue()
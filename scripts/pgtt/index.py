@@ -0,0 +1,88 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+from typing import List
+import logging
+
+# Internal deps
+from .mmu import Region
+
+
+class RegionIndex:
+    """
+    Sorted interval index over the regions of a memory map.
+
+    Regions are sorted by virtual address, checked for overlaps and coalesced
+    into the minimal list of disjoint runs so Table.gen only has to walk each
+    distinct run once.
+    """
+
+    def __init__( self, regions:List[Region] ):
+        """
+        Constructor.
+
+        args
+        ====
+
+            regions
+                        regions of the memory map, in any order; they are
+                        copied and never modified by the index
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.num_regions = len(regions)
+        self._runs = self._coalesce(sorted(regions, key=lambda r: (r.va, r.size)))
+        self.logger.debug(f"{self.num_regions} regions coalesced into {len(self._runs)} runs")
+
+
+    @staticmethod
+    def compatible( a:Region, b:Region ) -> bool:
+        """
+        Whether two regions translate with identical attributes and the same
+        va->pa offset, i.e. whether they may share a run.
+        """
+        return (a.mem_type == b.mem_type
+                and a.mem_attr == b.mem_attr
+                and a.large_page == b.large_page
+                and a.non_global == b.non_global
+                and a.va - a.pa == b.va - b.pa)
+
+
+    def _coalesce( self, regions:List[Region] ) -> List[Region]:
+        """
+        Merge sorted regions into disjoint runs.
+
+        Overlapping or adjacent regions are merged when compatible. Overlapping
+        regions that disagree on attributes or output address are rejected.
+        """
+        runs = []
+        for r in regions:
+            if runs and r.va <= runs[-1].va + runs[-1].size:
+                last = runs[-1]
+                last_end = last.va + last.size
+                if self.compatible(last, r):
+                    last.size = max(last_end, r.va + r.size) - last.va
+                    continue
+                if r.va < last_end:
+                    raise ValueError(
+                        f"region '{r.label}' {hex(r.va)}-{hex(r.va + r.size - 1)} overlaps "
+                        f"region '{last.label}' {hex(last.va)}-{hex(last_end - 1)}"
+                    )
+            runs.append(r.copy())
+        return runs
+
+
+    def runs( self ) -> List[Region]:
+        """
+        Disjoint runs sorted by virtual address.
+        Each call returns fresh copies as Table.map consumes the regions it is given.
+        """
+        return [r.copy() for r in self._runs]
+
+
+    def __len__( self ) -> int:
+        return len(self._runs)
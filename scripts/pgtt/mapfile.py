@@ -0,0 +1,192 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+from typing import List
+import csv
+import logging
+import os
+import struct
+
+# Optional deps
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Internal deps
+from .mmu import MemAttr, MemType, Region
+
+
+"""
+Binary memory map layout: an 8-byte magic followed by fixed-width
+little-endian records, one per region.
+
+    offset  size  field
+    0       8     va
+    8       8     pa
+    16      8     size in bytes
+    24      1     memory type, MemType value
+    25      1     attributes: bit 0 !w, bit 1 !x, bit 2 !s
+    26      1     large_page: 0 inherit, 1 false, 2 true, 3 "auto"
+    27      5     reserved, zero
+
+Regions have no labels in the binary format; they are named after the
+file and their record index instead.
+"""
+MAGIC = b"PGTMAP\x00\x01"
+RECORD = struct.Struct("<QQQBBB5x")
+LARGE_PAGE = (None, False, True, "auto")
+
+CSV_COLUMNS = ("va", "pa", "size", "type", "attr", "large_page", "description")
+ATTRS = {
+    f"{'!' if b & 1 else ''}w{'!' if b & 2 else ''}x{'!' if b & 4 else ''}s": b
+    for b in range(8)
+}
+_MEM_TYPES = [t.name for t in sorted(MemType, key=int)]
+_SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+logger = logging.getLogger("MapFile")
+logger.setLevel(logging.ERROR)
+
+
+def _mem_attr( bits:int ) -> MemAttr:
+    # force enable EL0 access, as for config.json attr strings
+    return MemAttr(0b11 if bits & 1 else 0b01, (bits >> 1) & 1, (bits >> 2) & 1)
+
+
+_MEM_ATTRS = [_mem_attr(b) for b in range(8)]
+
+
+def _align( va:int, size:int, tg:int ) -> int:
+    """
+    Grow size so [va, va + size) covers whole granules, as PgtConfig does.
+    """
+    up = (va + size) % tg
+    return size + va % tg + (tg - up if up else 0)
+
+
+def _columns( data, count:int ):
+    """
+    Decode count records from a bytes-like object into per-field lists,
+    using a numpy structured view when available.
+    """
+    if numpy is not None:
+        dtype = numpy.dtype({
+            "names":    ["va", "pa", "size", "type", "attr", "large_page"],
+            "formats":  ["<u8", "<u8", "<u8", "u1", "u1", "u1"],
+            "offsets":  [0, 8, 16, 24, 25, 26],
+            "itemsize": RECORD.size,
+        })
+        records = numpy.frombuffer(data, dtype=dtype, count=count, offset=len(MAGIC))
+        return [records[f].tolist() for f in dtype.names]
+    fields = zip(*RECORD.iter_unpack(memoryview(data)[len(MAGIC):len(MAGIC) + count * RECORD.size]))
+    return [list(f) for f in fields] or [[] for _ in range(6)]
+
+
+def read_binary( path:str, tg:int ) -> List[Region]:
+    """
+    Load the regions of a binary memory map.
+    """
+    with open(path, "rb") as fd:
+        data = fd.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path}: not a binary memory map (bad magic)")
+    count, rest = divmod(len(data) - len(MAGIC), RECORD.size)
+    if rest:
+        raise ValueError(f"{path}: truncated record at offset {len(data) - rest}")
+
+    vas, pas, sizes, types, attrs, large_pages = _columns(data, count)
+    for name, column, limit in (("type", types, len(_MEM_TYPES)), ("attr", attrs, 8), ("large_page", large_pages, 4)):
+        if column and max(column) >= limit:
+            bad = next(i for i, v in enumerate(column) if v >= limit)
+            raise ValueError(f"{path}: record {bad}: invalid {name} {column[bad]}")
+
+    label = os.path.basename(path)
+    regions = [
+        Region(0, f"{label}[{i}]", va, pa, _align(va, size, tg), _MEM_TYPES[t], _MEM_ATTRS[a], LARGE_PAGE[lp])
+        for i, (va, pa, size, t, a, lp) in enumerate(zip(vas, pas, sizes, types, attrs, large_pages))
+    ]
+    logger.debug(f"{len(regions)} regions read from {path}")
+    return regions
+
+
+def write_binary( path:str, regions:List[Region] ) -> None:
+    """
+    Write regions as a binary memory map.
+    """
+    with open(path, "wb") as fd:
+        fd.write(MAGIC)
+        for r in regions:
+            attr = (r.mem_attr.ap == 0b11) | (r.mem_attr.xn << 1) | (r.mem_attr.ns << 2)
+            fd.write(RECORD.pack(r.va, r.pa, r.size, MemType[r.mem_type], attr, LARGE_PAGE.index(r.large_page)))
+
+
+def _csv_size( s:str ) -> int:
+    # "4K"-style as in config.json maps, or a plain integer
+    if s[-1:].upper() in _SIZE_UNITS and s[:-1].isdigit():
+        return int(s[:-1]) * _SIZE_UNITS[s[-1].upper()]
+    return int(s, 0)
+
+
+def _csv_field( row:dict, column:str, lineno:int, path:str, parse ):
+    value = row.get(column)
+    if value is None or value == "":
+        raise ValueError(f"{path}:{lineno}: missing {column}")
+    try:
+        return parse(value.strip())
+    except (ValueError, KeyError, IndexError):
+        raise ValueError(f"{path}:{lineno}: invalid {column} {value!r}") from None
+
+
+def read_csv( path:str, tg:int ) -> List[Region]:
+    """
+    Load the regions of a CSV memory map.
+
+    The first line names the columns: va, pa, size, type and attr are
+    required, large_page and description optional. Addresses are integers
+    (0x for hex), sizes integers or a number followed by K, M, G or T as in
+    config.json maps, type a MemType name or value, attr a [!]w[!]x[!]s
+    string or its bit value as in the binary format, large_page true, false
+    or auto.
+    """
+    large_pages = {"": None, "true": True, "false": False, "auto": "auto"}
+    mem_types = {**{n: n for n in _MEM_TYPES}, **{str(i): n for i, n in enumerate(_MEM_TYPES)}}
+    mem_attrs = {**{s: _MEM_ATTRS[b] for s, b in ATTRS.items()}, **{str(b): _MEM_ATTRS[b] for b in range(8)}}
+    label = os.path.basename(path)
+
+    regions = []
+    with open(path, newline="") as fd:
+        reader = csv.DictReader(fd)
+        missing = [c for c in CSV_COLUMNS[:5] if c not in (reader.fieldnames or ())]
+        if missing:
+            raise ValueError(f"{path}:1: missing column(s) {', '.join(missing)}")
+        for row in reader:
+            lineno = reader.line_num
+            va = _csv_field(row, "va", lineno, path, lambda s: int(s, 0))
+            pa = _csv_field(row, "pa", lineno, path, lambda s: int(s, 0))
+            size = _csv_field(row, "size", lineno, path, _csv_size)
+            mem_type = _csv_field(row, "type", lineno, path, mem_types.__getitem__)
+            mem_attr = _csv_field(row, "attr", lineno, path, mem_attrs.__getitem__)
+            large_page = row.get("large_page") or ""
+            if large_page.strip().lower() not in large_pages:
+                raise ValueError(f"{path}:{lineno}: invalid large_page {large_page!r}")
+            regions.append(Region(
+                lineno, row.get("description") or f"{label}:{lineno}",
+                va, pa, _align(va, size, tg), mem_type, mem_attr,
+                large_pages[large_page.strip().lower()]
+            ))
+    logger.debug(f"{len(regions)} regions read from {path}")
+    return regions
+
+
+def read_map_file( path:str, tg:int ) -> List[Region]:
+    """
+    Load a memory map file, CSV if its name ends in .csv, binary otherwise.
+    """
+    if path.lower().endswith(".csv"):
+        return read_csv(path, tg)
+    return read_binary(path, tg)
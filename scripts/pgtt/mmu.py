@@ -6,7 +6,8 @@ SPDX-License-Identifier: MIT
 
 # Standard Python deps
 import math
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from functools import lru_cache
 from typing import List
 from enum import IntEnum
 
@@ -21,6 +22,14 @@ class MairEncode(IntEnum):
     NORMAL_WT       = 0xbb
     NORMAL          = 0xff
 
+class S2MemAttrEncode(IntEnum):
+    DEVICE_nGnRnE   = 0b0000
+    DEVICE_nGnRE    = 0b0001
+    DEVICE_GRE      = 0b0011
+    NORMAL_NC       = 0b0101
+    NORMAL_WT       = 0b1010
+    NORMAL          = 0b1111
+
 class MemType(IntEnum):
     DEVICE_nGnRnE   = 0
     DEVICE_nGnRE    = 1
@@ -29,7 +38,7 @@ class MemType(IntEnum):
     NORMAL_WT       = 4
     NORMAL          = 5
 
-@dataclass
+@dataclass(frozen=True)
 class MemAttr:
     ap:int
     xn:int
@@ -48,8 +57,8 @@ class Region:
     size: int                    # length in bytes
     mem_type: MemType         # True for Device-nGnRnE, False for Normal WB RAWA
     mem_attr: MemAttr
-    is_page = True             # whether this region is page or not
-    num_contig = 1
+    large_page: object = None      # per-region override of PgtConfig.large_page: True, False or "auto"
+    non_global: bool = False       # nG: translation tagged with the ASID of its address space
 
 
     def copy( self, **kwargs ):
@@ -57,10 +66,7 @@ class Region:
         Create a duplicate of this Region.
         Use kwargs to override this region's corresponding properties.
         """
-        region = Region(self.lineno, self.label, self.va, self.pa, self.size, self.mem_type, self.mem_attr)
-        for kw,arg in kwargs.items():
-            region.__dict__[kw] = arg
-        return region
+        return replace(self, **kwargs)
 
 
     def __str__( self ):
@@ -72,6 +78,18 @@ class Region:
         )
 
 
+@dataclass
+class AddressSpace:
+    """
+    Class representing one ASID-tagged address space: non-global regions
+    mapped on top of the global regions shared by every space.
+    """
+
+    asid: int                      # ASID programmed into TTBR0 with this space's tables
+    label: str
+    regions: List[Region]
+
+
 class MmuConfig:
 
     def __init__(self, pgt_conf):
@@ -108,8 +126,16 @@ class MmuConfig:
             #log.debug(f"start_level corrected as {args.tsz=} exactly fits in first table")
         #log.debug(f"{start_level=}")
 
+        """
+        Number of tables concatenated at the starting level, stage 2 only.
+        """
+        self.root_tables = 1
+        if pgt_conf.stage == 2:
+            self.start_level, self.root_tables = self._s2_start()
+
         self.tcr = self._tcr()
         self.sctlr = self._sctlr()
+        self.vtcr = self._vtcr() if pgt_conf.stage == 2 else None
 
         self.mem_types = {i.name: i.value for i in MemType}
         self.mair_encodes = {i.name: i.value for i in MairEncode}
@@ -117,76 +143,182 @@ class MmuConfig:
         self.mair = self._mair()
         self.ttbr = pgt_conf.ttbr
 
-    def _mair(self):
-        mair = 0
-        for k in self.mair_encodes.keys():
-            mair |= (self.mair_encodes[k] << (self.mem_types[k] * 8))
-        return hex(mair)
 
-    def _tcr(self) -> str:
+    def _s2_start(self) -> tuple:
         """
-        Generate required value for TCR_ELn.
+        Stage 2 (starting level, number of concatenated tables): the deepest
+        level VTCR_EL2.SL0 can select whose initial lookup needs at most 16
+        tables, e.g. level 1 with 2 tables rather than level 0 for a 40-bit
+        IPA space with a 4K granule, saving a level on every walk.
         """
-        reg = Register(f"tcr_el{self.pgt_conf.el}")
+        levels = range(0, 3) if self.pgt_conf.tg_str == "4K" else range(1, 4)
+        for level in reversed(levels):
+            shift = self.block_offset_bits + (3 - level) * self.table_idx_bits
+            tables = 1 << max(0, self.pgt_conf.tsz - shift - self.table_idx_bits)
+            if tables <= 16:
+                return level, tables
+        raise ValueError(f"IPA size {self.pgt_conf.tsz} needs more than 16 concatenated tables")
+
 
+    def block_levels(self) -> range:
         """
-        Configurable bitfields present at all exception levels.
+        Levels at which an entry may be a block descriptor for this granule.
         """
-        reg.field( 5,  0, "t0sz", 64-self.pgt_conf.tsz)
-        reg.field( 9,  8, "irgn0", 1)  # Normal WB RAWA
-        reg.field(11, 10, "orgn0", 1)  # Normal WB RAWA
-        reg.field(13, 12, "sh0", 3)    # Inner Shareable
-        reg.field(15, 14, "tg0", {"4K":0, "16K":2, "64K":1}[self.pgt_conf.tg_str])
+        return range(1, 3) if self.pgt_conf.tg_str == "4K" else range(2, 3)
 
+
+    def contig_entries(self, level:int) -> int:
         """
-        Bits that are RES1 at all exception levels.
+        Number of adjacent entries the Contiguous hint covers at this level,
+        or 0 if the granule has no contiguous blocks/pages at this level.
         """
-        reg.res1(23) # technically epd1 at EL1 but we'll want =1 then anyway
+        return {
+            "4K":  {1: 16, 2: 16, 3: 16},
+            "16K": {2: 32, 3: 128},
+            "64K": {2: 32, 3: 32},
+        }[self.pgt_conf.tg_str].get(level, 0)
+
+    def _mair(self):
+        return hex(_mair_value())
 
+    def _tcr(self) -> str:
         """
-        Exception level specific differences.
+        Generate required value for TCR_ELn.
         """
-        ps_val = {32:0, 36:1, 40:2, 48:5}[self.pgt_conf.tsz]
-        if self.pgt_conf.el == 1:
-            reg.field(34, 32, "ps", ps_val)
-        else:
-            reg.field(18, 16, "ps", ps_val)
-            reg.res1(31)
+        return hex(_tcr_value(self.pgt_conf.el, self.pgt_conf.tsz, self.pgt_conf.tg_str))
+
 
-        return hex(reg.value())
+    def _vtcr(self) -> str:
+        """
+        Generate required value for VTCR_EL2.
+        """
+        return hex(_vtcr_value(self.pgt_conf.tsz, self.pgt_conf.tg_str, self.start_level))
 
 
     def _sctlr(self) -> str:
         """
         Generate required value for SCTLR_ELn.
         """
-        reg = Register(f"sctlr_el{self.pgt_conf.el}")
+        return hex(_sctlr_value(self.pgt_conf.el))
+
 
+    def entry_template(self, mem_type, mem_attr, is_page:bool, contiguous:bool=False, non_global:bool=False ) -> str:
         """
-        Configurable bitfields present at all exception levels.
+        Translation table entry fields common across all exception levels, as a hex string.
         """
-        reg.field( 0,  0, "m", 1)    # MMU enabled
-        reg.field( 2,  2, "c", 1)    # D-side access cacheability controlled by pgtables
-        reg.field(12, 12, "i", 1),   # I-side access cacheability controlled by pgtables
+        return hex(self.entry_template_value(mem_type, mem_attr, is_page, contiguous, non_global))
 
 
-        return hex(reg.value())
-
-
-    def entry_template(self, mem_type, mem_attr, is_page:bool ):
+    def entry_template_value(self, mem_type, mem_attr, is_page:bool, contiguous:bool=False, non_global:bool=False ) -> int:
         """
         Translation table entry fields common across all exception levels.
+        Memoized on (mem_type, mem_attr, is_page, contiguous, non_global).
         """
-        pte = Register("pte")
-        pte.field( 0,  0, "valid", 1)
-        pte.field( 1,  1, "[1]", int(is_page))
-        pte.field( 4,  2, "attrindx", self.mem_types[mem_type])
-        pte.field( 5,  5, "ns", mem_attr.ns)
-        pte.field( 7,  6, "AP", mem_attr.ap)
-        pte.field( 9,  8, "sh", 3)  # Inner Shareable, ignored by Device memory
-        pte.field(10, 10, "af", 1)  # Disable Access Flag faults
-        pte.field(53, 53, "pxn", mem_attr.ns)
-        pte.field(54, 54, "xn", mem_attr.ns)
+        if self.pgt_conf.stage == 2:
+            return _s2_entry_template_value(mem_type, mem_attr, bool(is_page), bool(contiguous))
+        return _entry_template_value(mem_type, mem_attr, bool(is_page), bool(contiguous), bool(non_global))
+
+
+"""
+Register values only depend on a handful of hashable settings, so they are
+computed once per distinct key instead of once per call.
+"""
+@lru_cache(maxsize=None)
+def _mair_value() -> int:
+    mair = 0
+    for t in MemType:
+        mair |= (MairEncode[t.name] << (t.value * 8))
+    return mair
+
+
+@lru_cache(maxsize=None)
+def _tcr_value(el:int, tsz:int, tg_str:str) -> int:
+    reg = Register(f"tcr_el{el}")
+
+    """
+    Configurable bitfields present at all exception levels.
+    """
+    reg.field( 5,  0, "t0sz", 64-tsz)
+    reg.field( 9,  8, "irgn0", 1)  # Normal WB RAWA
+    reg.field(11, 10, "orgn0", 1)  # Normal WB RAWA
+    reg.field(13, 12, "sh0", 3)    # Inner Shareable
+    reg.field(15, 14, "tg0", {"4K":0, "16K":2, "64K":1}[tg_str])
+
+    """
+    Bits that are RES1 at all exception levels.
+    """
+    reg.res1(23) # technically epd1 at EL1 but we'll want =1 then anyway
+
+    """
+    Exception level specific differences.
+    """
+    ps_val = {32:0, 36:1, 40:2, 48:5}[tsz]
+    if el == 1:
+        reg.field(34, 32, "ps", ps_val)
+    else:
+        reg.field(18, 16, "ps", ps_val)
+        reg.res1(31)
+
+    return reg.value()
 
-        return hex(pte.value())
 
+@lru_cache(maxsize=None)
+def _vtcr_value(tsz:int, tg_str:str, start_level:int) -> int:
+    reg = Register("vtcr_el2")
+    reg.field( 5,  0, "t0sz", 64-tsz)
+    reg.field( 7,  6, "sl0", (2 if tg_str == "4K" else 3) - start_level)
+    reg.field( 9,  8, "irgn0", 1)  # Normal WB RAWA
+    reg.field(11, 10, "orgn0", 1)  # Normal WB RAWA
+    reg.field(13, 12, "sh0", 3)    # Inner Shareable
+    reg.field(15, 14, "tg0", {"4K":0, "16K":2, "64K":1}[tg_str])
+    reg.field(18, 16, "ps", {32:0, 36:1, 40:2, 48:5}[tsz])
+    reg.res1(31)
+
+    return reg.value()
+
+
+@lru_cache(maxsize=None)
+def _sctlr_value(el:int) -> int:
+    reg = Register(f"sctlr_el{el}")
+
+    """
+    Configurable bitfields present at all exception levels.
+    """
+    reg.field( 0,  0, "m", 1)    # MMU enabled
+    reg.field( 2,  2, "c", 1)    # D-side access cacheability controlled by pgtables
+    reg.field(12, 12, "i", 1),   # I-side access cacheability controlled by pgtables
+
+    return reg.value()
+
+
+@lru_cache(maxsize=None)
+def _entry_template_value(mem_type, mem_attr:MemAttr, is_page:bool, contiguous:bool, non_global:bool) -> int:
+    pte = Register("pte")
+    pte.field( 0,  0, "valid", 1)
+    pte.field( 1,  1, "[1]", int(is_page))
+    pte.field( 4,  2, "attrindx", MemType[mem_type])
+    pte.field( 5,  5, "ns", mem_attr.ns)
+    pte.field( 7,  6, "AP", mem_attr.ap)
+    pte.field( 9,  8, "sh", 3)  # Inner Shareable, ignored by Device memory
+    pte.field(10, 10, "af", 1)  # Disable Access Flag faults
+    pte.field(11, 11, "nG", int(non_global))
+    pte.field(52, 52, "contiguous", int(contiguous))
+    pte.field(53, 53, "pxn", mem_attr.ns)
+    pte.field(54, 54, "xn", mem_attr.ns)
+
+    return pte.value()
+
+
+@lru_cache(maxsize=None)
+def _s2_entry_template_value(mem_type, mem_attr:MemAttr, is_page:bool, contiguous:bool) -> int:
+    pte = Register("s2_pte")
+    pte.field( 0,  0, "valid", 1)
+    pte.field( 1,  1, "[1]", int(is_page))
+    pte.field( 5,  2, "memattr", S2MemAttrEncode[mem_type])
+    pte.field( 7,  6, "S2AP", 0b01 if mem_attr.ap & 0b10 else 0b11)  # read-only as AP[2], else read/write
+    pte.field( 9,  8, "sh", 3)  # Inner Shareable, ignored by Device memory
+    pte.field(10, 10, "af", 1)  # Disable Access Flag faults
+    pte.field(52, 52, "contiguous", int(contiguous))
+    pte.field(54, 54, "xn", mem_attr.xn)
+
+    return pte.value()
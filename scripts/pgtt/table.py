@@ -5,21 +5,172 @@ SPDX-License-Identifier: MIT
 """
 
 # Standard Python deps
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from typing import List
+import copy
+import io
 import logging
+import os
 
 # Internal deps
+from .index import RegionIndex
+
+
+logger = logging.getLogger("Table")
+logger.setLevel(logging.ERROR)
+
+
+class TableAllocator:
+    """
+    Class assigning addresses to the translation tables of one generation run.
+
+    Tables are laid out back to back, one granule each (a stage 2 root of
+    concatenated tables takes several), from the table base address in
+    allocation order. Each Table.gen call owns its own allocator
+    so independent pagetable configs never share or offset each other's tables.
+    """
+
+    def __init__( self, ttbr:int, tg:int, tg_str:str="" ):
+        self.ttbr = ttbr
+        self.tg = tg
+        self.tg_str = tg_str
+        self.tables = []
+        self.granules = 0
+        self.tracking = True
+        self.dirty = {}
+        self.shared = 0             # duplicate tables released by Table.dedupe
+
+
+    def mark_dirty( self, table, idx:int, count:int=1 ) -> None:
+        """
+        Record that entries [idx, idx + count) of table changed.
+        """
+        if self.tracking:
+            self.dirty.setdefault(table, set()).update(range(idx, idx + count))
+
+
+    def clear_dirty( self ) -> None:
+        """
+        Forget all changes, e.g. once they have been emitted.
+        """
+        self.dirty = {}
+
+
+    def alloc( self, table, granules:int=1 ) -> int:
+        """
+        Record a new table of granules granules and return its address.
+        """
+        addr = self.ttbr + self.granules * self.tg
+        self.tables.append(table)
+        self.granules += granules
+        return addr
+
+
+    def release( self, tables ) -> None:
+        """
+        Drop tables from the layout and move every later table down to close
+        the gaps, keeping allocation order.
+        """
+        self.tables = [t for t in self.tables if t not in tables]
+        self.granules = 0
+        for t in self.tables:
+            t.addr = self.ttbr + self.granules * self.tg
+            self.granules += t.granules
+
+
+    def size( self ) -> int:
+        """
+        Combined length in bytes of all allocated tables.
+        """
+        return self.tg * self.granules
+
+
+    def usage( self ) -> str:
+        """
+        Generate memory allocation usage information for the user.
+        """
+        string  = f"This memory map requires a total of {len(self.tables)} translation tables.\n"
+        string += f"Each table occupies {self.tg_str} of memory ({hex(self.tg)} bytes).\n"
+        if self.granules != len(self.tables):
+            string += f"The initial table is {self.granules - len(self.tables) + 1} concatenated tables.\n"
+        string += f"The buffer pointed to by {hex(self.ttbr)} must therefore be {self.granules}x {self.tg_str} = {hex(self.size())} bytes long."
+        if self.tables:
+            saved = self.tables[0].tables_saved()
+            string += f"\nBlock mappings save {saved} tables ({hex(saved * self.tg)} bytes) over mapping every page."
+        if self.shared:
+            string += f"\nSharing identical tables saves a further {self.shared} tables ({hex(self.shared * self.tg)} bytes)."
+        return string
+
+
+    def __len__( self ) -> int:
+        return len(self.tables)
+
+
+    def __iter__( self ):
+        return iter(self.tables)
+
+
+class Run:
+    """
+    Class representing a run of block/page entries with consecutive output
+    addresses. Only the first entry of a run is stored in Table.entries, and
+    the label and attributes are shared with the Region that was mapped.
+    """
+    __slots__ = ("pa", "num_contig", "region", "is_page", "contiguous")
+
+
+    def __init__( self, pa:int, num_contig:int, region, is_page:bool, contiguous:bool=False ):
+        self.pa = pa                    # output address of the first entry
+        self.num_contig = num_contig    # number of entries in the run
+        self.region = region            # source region, for label and attributes
+        self.is_page = is_page          # page (level 3) rather than block
+        self.contiguous = contiguous    # whether the run sets the Contiguous hint
+
+
+    def __reduce__( self ):
+        # much cheaper to pickle than the generic __slots__ state
+        return Run, (self.pa, self.num_contig, self.region, self.is_page, self.contiguous)
+
+
+    @property
+    def label( self ):
+        return self.region.label
+
+
+    @property
+    def mem_type( self ):
+        return self.region.mem_type
+
+
+    @property
+    def mem_attr( self ):
+        return self.region.mem_attr
+
+
+    @property
+    def non_global( self ):
+        return self.region.non_global
+
+
+    def split( self, n:int, chunk:int ):
+        """
+        Shorten this run to its first n entries and return the remainder as
+        a new run. Both halves lose the Contiguous hint.
+        """
+        rest = Run(self.pa + n * chunk, self.num_contig - n, self.region, self.is_page)
+        self.num_contig = n
+        self.contiguous = False
+        return rest
 
 
 class Table:
     """
     Class representing a translation table.
     """
-    _allocated = []
+    __slots__ = ("mmu_conf", "allocator", "addr", "level", "chunk", "va_base", "entries")
 
-
-    def __init__( self, level, mmu_conf, va_base=0 ):
+    def __init__( self, level, mmu_conf, va_base=0, allocator=None ):
         """
         Constructor.
 
@@ -32,17 +183,52 @@ class Table:
             va_base
                         base virtual address mapped by entry [0] in this table
 
+            allocator
+                        TableAllocator assigning this table's address, a new
+                        one is created for a root table when left as None
+
         """
-        self.logger = logging.getLogger(type(self).__name__)
-        self.logger.setLevel(logging.ERROR)
-        self.pgt_conf = mmu_conf.pgt_conf
         self.mmu_conf = mmu_conf
-        self.addr = self.pgt_conf.ttbr + len(Table._allocated) * self.pgt_conf.tg
         self.level = level
+        if allocator is None:
+            allocator = TableAllocator(self.pgt_conf.ttbr, self.pgt_conf.tg, self.pgt_conf.tg_str)
+        self.allocator = allocator
+        self.addr = allocator.alloc(self, self.granules)
         self.chunk = self.pgt_conf.tg << ((3 - self.level) * self.mmu_conf.table_idx_bits)
         self.va_base = va_base
         self.entries = {}
-        Table._allocated.append(self)
+
+
+    def __getstate__( self ):
+        """
+        Tables pickle detached from their MmuConfig and TableAllocator, for
+        gen_parallel to re-attach them to its own.
+        """
+        return self.level, self.chunk, self.va_base, self.entries
+
+
+    def __setstate__( self, state ) -> None:
+        self.level, self.chunk, self.va_base, self.entries = state
+        self.mmu_conf = self.allocator = self.addr = None
+
+
+    @property
+    def pgt_conf( self ):
+        return self.mmu_conf.pgt_conf
+
+
+    @property
+    def granules( self ) -> int:
+        """
+        Number of granules this table occupies: several for a stage 2
+        starting level made of concatenated tables, otherwise one.
+        """
+        return self.mmu_conf.root_tables if self.level == self.mmu_conf.start_level else 1
+
+
+    @property
+    def num_entries( self ) -> int:
+        return self.mmu_conf.entries_per_table * self.granules
 
 
     def prepare_next( self, idx:int, va_base:int=None ) -> None:
@@ -53,11 +239,16 @@ class Table:
         Leave va_base=None to default to self.va_base + idx * self.chunk.
         """
         if not idx in self.entries:
-            self.entries[idx] = Table(
+            table = Table(
                 self.level + 1,
                 self.mmu_conf,
-                va_base if not va_base is None else (self.va_base + idx * self.chunk)
+                va_base if not va_base is None else (self.va_base + idx * self.chunk),
+                self.allocator
             )
+            self.entries[idx] = table
+            self.allocator.mark_dirty(self, idx)
+            # memory of a table allocated after mmu_on was never cleared
+            self.allocator.mark_dirty(table, 0, table.num_entries)
 
 
     def map( self, region) -> None:
@@ -66,9 +257,10 @@ class Table:
         """
         margin = " " * (self.level - self.mmu_conf.start_level + 1) * 8
 
-        self.logger.debug(margin + f"mapping region {hex(region.va)} in level {self.level} table")
+        logger.debug(margin + f"mapping region {hex(region.va)} in level {self.level} table")
+        assert(not self.allocator.shared)
         assert(region.va >= self.va_base)
-        assert(region.va + region.size <= self.va_base + self.mmu_conf.entries_per_table * self.chunk)
+        assert(region.va + region.size <= self.va_base + self.num_entries * self.chunk)
 
         """
         Calculate number of chunks required to map this region.
@@ -77,14 +269,16 @@ class Table:
         """
         num_chunks = region.size // self.chunk
         entry_idx_shift = (3 - self.level) * self.mmu_conf.table_idx_bits + self.mmu_conf.block_offset_bits
-        start_idx = (region.va >> entry_idx_shift) & self.mmu_conf.table_idx_mask
+        start_idx = (region.va - self.va_base) >> entry_idx_shift
 
         end_va = region.va + region.size
         end_pa = region.pa + region.size
 
         """
-        Check whether the region is "floating".
+        Check whether the region is "floating", i.e. within a single chunk.
         If so, dispatch to next-level table and we're finished.
+        A region smaller than a chunk that crosses a chunk boundary is
+        handled below as an underflow plus an overflow.
 
                     +--------------------+
                  // |                    |
@@ -92,8 +286,8 @@ class Table:
                  \\ |                    |
                     +--------------------+
         """
-        if num_chunks == 0:
-            self.logger.debug(margin + f"floating region, dispatching to next-level table")
+        if num_chunks == 0 and (region.va + region.size - 1) // self.chunk == region.va // self.chunk:
+            logger.debug(margin + f"floating region, dispatching to next-level table")
             self.prepare_next(start_idx)
             self.entries[start_idx].map(region)
             return
@@ -114,7 +308,7 @@ class Table:
         """
         underflow = region.va % self.chunk
         if underflow:
-            self.logger.debug(margin + f"{underflow=}, dispatching to next-level table")
+            logger.debug(margin + f"{underflow=}, dispatching to next-level table")
             delta = self.chunk - underflow
             self.prepare_next(start_idx)
             self.entries[start_idx].map(region.copy(size = delta))
@@ -139,80 +333,529 @@ class Table:
         """
         overflow = end_va % self.chunk
         if overflow:
-            self.logger.debug(margin + f"{overflow=}, dispatching to next-level table")
-            final_idx = (end_va >> entry_idx_shift) & self.mmu_conf.table_idx_mask
+            logger.debug(margin + f"{overflow=}, dispatching to next-level table")
+            final_idx = (end_va - self.va_base) >> entry_idx_shift
             va_base = (end_va // self.chunk) * self.chunk
             pa_base = end_pa - (end_va - va_base)
             self.prepare_next(final_idx, va_base)
             self.entries[final_idx].map(region.copy(va=va_base, pa=pa_base, size=overflow))
-            region.size -= (self.chunk - overflow)
+            region.size -= overflow
 
         num_chunks = region.size // self.chunk
         """
         Handle any remaining complete chunks.
         """
         region.size = self.chunk
-        can_split_level_min = (1 if self.pgt_conf.tg_str == "4K" else 2)
-        can_split = ((self.level >= can_split_level_min) and self.level < 3) and (not self.pgt_conf.large_page)
-        num_contiguous_blocks = 0
+        if not self.can_split(region):
+            if num_chunks > 0:
+                logger.debug(margin + f"mapping {num_chunks} complete chunks from index {start_idx}")
+                self.allocator.mark_dirty(self, start_idx, num_chunks)
+                self.mark_run(start_idx, Run(region.pa, num_chunks, region, self.level == 3))
+            return
+
         for i in range(start_idx, start_idx + num_chunks):
-            self.logger.debug(margin + f"mapping complete chunk at index {i}")
+            logger.debug(margin + f"mapping complete chunk at index {i}")
             va_base = self.va_base + i * self.chunk
             pa_base = region.pa + (i - start_idx) * self.chunk
-            r = region.copy(va=va_base, pa=pa_base)
-            if can_split:
-                self.prepare_next(i)
-                self.entries[i].map(r)
+            self.prepare_next(i)
+            self.entries[i].map(region.copy(va=va_base, pa=pa_base))
+
+
+    def unmap( self, region ) -> None:
+        """
+        Remove the translation of [region.va, region.va + region.size) from
+        this translation table, leaving the rest of the map untouched.
+
+        Blocks only partially covered by the region are first split into a
+        next-level table mapping the same range, so the remainder survives.
+        Every entry changed is recorded in the allocator's dirty set.
+        """
+        assert(not self.allocator.shared)
+        start = max(region.va, self.va_base)
+        end = min(region.va + region.size, self.va_base + self.num_entries * self.chunk)
+        if start >= end:
+            return
+
+        first_idx = (start - self.va_base) // self.chunk
+        last_idx = (end - 1 - self.va_base) // self.chunk
+        """
+        Split runs so the possibly partially covered first and last entries
+        are runs of their own and no run crosses the unmapped range.
+        """
+        for idx in (first_idx, first_idx + 1, last_idx, last_idx + 1):
+            self._split_at(idx)
+
+        for idx in sorted(k for k in self.entries if first_idx <= k <= last_idx):
+            entry = self.entries[idx]
+            entry_va = self.va_base + idx * self.chunk
+            num_entries = entry.num_contig if type(entry) is Run else 1
+            covered = start <= entry_va and entry_va + num_entries * self.chunk <= end
+
+            if type(entry) is Run:
+                del self.entries[idx]
+                self.allocator.mark_dirty(self, idx, num_entries)
+                if covered:
+                    continue
+                """
+                Partially covered block: remap it through a next-level table.
+                """
+                self.prepare_next(idx)
+                self.entries[idx].map(entry.region.copy(va=entry_va, pa=entry.pa, size=self.chunk))
+                entry = self.entries[idx]
+
+            if covered:
+                del self.entries[idx]
+                self.allocator.mark_dirty(self, idx)
             else:
-                if self.level < 3:
-                    r.is_page = False
-                self.entries[i] = r
-            num_contiguous_blocks += 1
-        if num_contiguous_blocks > 0:
-            self.entries[start_idx].num_contig = num_contiguous_blocks
+                entry.unmap(region)
 
 
-    def __str__( self ) -> str:
+    def _split_at( self, idx:int ) -> None:
         """
-        Recursively crawl this table to generate a pretty-printable string.
+        Make entry [idx] the first entry of a run by splitting the run that
+        contains it, if any. A run that had the Contiguous hint loses it, so
+        all of its entries change.
+        """
+        if idx in self.entries:
+            return
+        head = idx - 1
+        while head >= 0 and head not in self.entries:
+            head -= 1
+        run = self.entries.get(head)
+        if type(run) is not Run or head + run.num_contig <= idx:
+            return
+        if run.contiguous:
+            self.allocator.mark_dirty(self, head, run.num_contig)
+        self.entries[idx] = run.split(idx - head, self.chunk)
+
+
+    def can_split( self, region ) -> bool:
+        """
+        Whether complete chunks of region are split into next-level tables
+        rather than mapped as blocks in this table.
+
+        large_page, from the region or else from the pagetable config, selects:
+
+            False       split down to level 3 pages
+            True        never split
+            "auto"      split only where this level cannot hold a block, so
+                        each aligned sub-range uses the largest legal block
+
+        Chunks whose output address is not aligned to the chunk size are
+        always split, whatever large_page says.
+        """
+        return _can_split(self.mmu_conf, self.level, region)
+
+
+    def _content_key( self ) -> tuple:
+        """
+        Key equal for two tables exactly when their descriptors are: runs
+        that continue each other are merged, so run boundaries left by
+        mapping order or unmap do not matter, and next-level tables compare
+        by identity.
+        """
+        key = [self.level]
+        for idx, entry, run_length in self.runs():
+            if type(entry) is Table:
+                key.append((idx, entry))
+                continue
+            template = self.mmu_conf.entry_template_value(entry.mem_type, entry.mem_attr, entry.is_page, entry.contiguous, entry.non_global)
+            last = key[-1]
+            if (type(last) is list and last[0] + last[1] == idx and last[3] == template
+                    and last[2] + last[1] * self.chunk == entry.pa):
+                last[1] += run_length
+            else:
+                key.append([idx, run_length, entry.pa, template])
+        return tuple(tuple(k) if type(k) is list else k for k in key)
+
+
+    def dedupe( self ) -> int:
+        """
+        Share next-level tables whose descriptors are identical, e.g. the
+        tables of aliases mapping the same output range with the same
+        attributes, and close up the table memory they leave free.
+
+        Tables are keyed by content bottom-up, so once their children are
+        shared, parents that become identical are shared in turn. The first
+        table in allocation order of each set of duplicates is kept. Every
+        tree in the allocator takes part, so the tables of global mappings
+        are shared between address spaces too; roots never are.
+        Returns the number of tables released.
+
+        This is a final pass: the tree must not be mapped or unmapped into
+        afterwards, as a change to a shared table would show through every
+        entry pointing to it.
+        """
+        kept = {}
+        duplicates = {}
+        for t in sorted(self.allocator, key=lambda t: -t.level):
+            for idx, entry in t.entries.items():
+                if type(entry) is Table and entry in duplicates:
+                    t.entries[idx] = duplicates[entry]
+            if t.level == self.mmu_conf.start_level:
+                continue        # roots of address spaces are each pointed to by a TTBR
+            first = kept.setdefault(t._content_key(), t)
+            if first is not t:
+                duplicates[t] = first
+        if duplicates:
+            self.allocator.release(duplicates)
+            self.allocator.shared += len(duplicates)
+        logger.debug(f"{len(duplicates)} duplicate tables shared")
+        return len(duplicates)
+
+
+    def tables_saved( self ) -> int:
+        """
+        Number of tables the blocks mapped beneath this table avoid allocating
+        compared with splitting every splittable block down to level 3 pages.
         """
+        can_split_level_min = (1 if self.pgt_conf.tg_str == "4K" else 2)
+        saved = 0
+        for table in self.allocator:
+            if table.level < can_split_level_min or table.level >= 3:
+                continue
+            per_block = sum(self.mmu_conf.entries_per_table ** k for k in range(3 - table.level))
+            for idx, entry, run_length in table.runs():
+                if type(entry) is not Table:
+                    saved += run_length * per_block
+        return saved
+
+
+    def mark_run( self, start_idx:int, run:Run ) -> None:
+        """
+        Store run as entries [start_idx, start_idx + run.num_contig).
+
+        With the contiguous hint enabled, every naturally aligned group of
+        MmuConfig.contig_entries(level) entries whose output address is
+        aligned to the size of the group becomes a run of its own with the
+        Contiguous bit set, leaving any unaligned head and tail as plain runs.
+        """
+        group = self.mmu_conf.contig_entries(self.level) if self.pgt_conf.contiguous_hint else 0
+        if not group or (run.pa - start_idx * self.chunk) % (group * self.chunk):
+            self.entries[start_idx] = run
+            return
+
+        end = start_idx + run.num_contig
+        plain = start_idx
+        idx = -(-start_idx // group) * group
+        while idx + group <= end:
+            if plain < idx:
+                self._add_run(run, plain, idx - plain, start_idx, False)
+            self._add_run(run, idx, group, start_idx, True)
+            idx += group
+            plain = idx
+        if plain < end:
+            self._add_run(run, plain, end - plain, start_idx, False)
+
+
+    def _add_run( self, run:Run, idx:int, count:int, start_idx:int, contiguous:bool ) -> None:
+        pa = run.pa + (idx - start_idx) * self.chunk
+        self.entries[idx] = Run(pa, count, run.region, run.is_page, contiguous)
+
+
+    def runs( self ):
+        """
+        Walk the entries of this table in index order in a single pass.
+
+        Yields (idx, entry, run_length) where run_length is the number of
+        consecutive entries described by entry: Run.num_contig for a run of
+        blocks/pages, or 1 for a pointer to a next-level table.
+        """
+        for idx in sorted(self.entries.keys()):
+            entry = self.entries[idx]
+            yield idx, entry, (1 if type(entry) is Table else entry.num_contig)
+
+
+    def _title( self, va_base:int ) -> str:
+        margin = " " * (self.level - self.mmu_conf.start_level + 1) * 8
+        title = f"{margin}level {self.level} table @ {hex(self.addr)}"
+        if va_base != self.va_base:
+            title += f" (shared with {hex(self.va_base)})"
+        return title
+
+
+    def dump( self, fd, va_base:int=None ) -> None:
+        """
+        Recursively crawl this table, streaming a pretty-printable dump to an
+        open text file object.
+
+        va_base is the virtual address this table is reached at, passed down
+        from the parent entry, as a table shared by Table.dedupe is reached at
+        several. Leave it as None to default to self.va_base. Labels are those
+        of the regions mapped where the table was first allocated, so a table
+        reached elsewhere is marked as shared with that address.
+        """
+        if va_base is None:
+            va_base = self.va_base
         margin = " " * (self.level - self.mmu_conf.start_level + 1) * 8
-        string = f"{margin}level {self.level} table @ {hex(self.addr)}\n"
-        for k in sorted(list(self.entries.keys())):
+        fd.write(f"{self._title(va_base)}\n")
+        for k in sorted(self.entries.keys()):
             entry = self.entries[k]
             if type(entry) is Table:
                 header = "{}[#{:>4}]".format(margin, k)
-                nested_table = str(entry)
-                hyphens = "-" * (len(nested_table.splitlines()[0]) - len(header))
-                string += f"{header}" + hyphens + f"\\\n{nested_table}"
+                entry_va = va_base + k * self.chunk
+                hyphens = "-" * (len(entry._title(entry_va)) - len(header))
+                fd.write(f"{header}" + hyphens + "\\\n")
+                entry.dump(fd, entry_va)
             else:
-                string += "{}[#{:>4}] 0x{:>012x}-0x{:>012x}, 0x{:>012x}-0x{:>012x}, {}, {}, {}\n".format(
-                    margin,
-                    k,
-                    entry.va,
-                    entry.va + entry.size - 1,
-                    entry.pa,
-                    entry.pa + entry.size - 1,
-                    entry.mem_type,
-                    "PAGE" if entry.is_page else "BLOCK",
-                    entry.label
-                )
-        return string
+                for i in range(entry.num_contig):
+                    va = va_base + (k + i) * self.chunk
+                    pa = entry.pa + i * self.chunk
+                    fd.write("{}[#{:>4}] 0x{:>012x}-0x{:>012x}, 0x{:>012x}-0x{:>012x}, {}, {}, {}\n".format(
+                        margin,
+                        k + i,
+                        va,
+                        va + self.chunk - 1,
+                        pa,
+                        pa + self.chunk - 1,
+                        entry.mem_type,
+                        ("PAGE" if entry.is_page else "BLOCK") + (" nG" if entry.non_global else ""),
+                        entry.label
+                    ))
 
 
-    #@classmethod
-    #def usage( cls ) -> str:
-    #    """
-    #    Generate memory allocation usage information for the user.
-    #    """
-    #    string  = f"This memory map requires a total of {len(cls._allocated)} translation tables.\n"
-    #    string += f"Each table occupies {args.tg_str} of memory ({hex(args.tg)} bytes).\n"
-    #    string += f"The buffer pointed to by {hex(args.ttb)} must therefore be {len(cls._allocated)}x {args.tg_str} = {hex(args.tg * len(cls._allocated))} bytes long."
-    #    return string
+    def __str__( self ) -> str:
+        """
+        Recursively crawl this table to generate a pretty-printable string.
+        """
+        string = io.StringIO()
+        self.dump(string)
+        return string.getvalue()
+
 
     @classmethod
-    def gen(cls, level, mmu_conf):
-        root = Table(level, mmu_conf)
-        [root.map(r) for r in mmu_conf.pgt_conf.regions]
+    def gen(cls, level, mmu_conf, jobs:int=1, regions=None, allocator=None):
+        """
+        Build the translation tables for the memory map in mmu_conf, or for
+        regions instead when given.
+
+        Regions are first coalesced by a RegionIndex so overlapping maps are
+        rejected and adjacent compatible regions are mapped as a single run.
+
+        With jobs other than 1 (0 or None: one per CPU) the subtrees below
+        each root table entry are built in worker processes, see gen_parallel.
+        An allocator already holding other tables lays the new ones out after
+        them, see gen_spaces.
+        """
+        regions = mmu_conf.pgt_conf.regions if regions is None else regions
+        if jobs != 1:
+            return gen_parallel(level, mmu_conf, jobs, regions, allocator)
+        root = Table(level, mmu_conf, 0, allocator)
+        root.allocator.tracking = False
+        [root.map(r) for r in RegionIndex(regions).runs()]
+        root.allocator.tracking = True
         return root
 
+
+    @classmethod
+    def gen_spaces(cls, level, mmu_conf, jobs:int=1):
+        """
+        Build one table tree per address space of the pagetable config, each
+        mapping the global regions plus the space's own non-global ones.
+
+        All trees share one allocator, so the tables of every space sit back
+        to back from ttbr, space by space, and are zeroed, filled and written
+        out together. Returns the roots in address_spaces order.
+        """
+        roots = []
+        allocator = None
+        for space in mmu_conf.pgt_conf.address_spaces:
+            root = cls.gen(level, mmu_conf, jobs, mmu_conf.pgt_conf.regions + space.regions, allocator)
+            allocator = root.allocator
+            roots.append(root)
+        return roots
+
+
+
+def _chunk( mmu_conf, level:int ) -> int:
+    """
+    Size of the memory mapped by each entry of a table at this level.
+    """
+    return mmu_conf.pgt_conf.tg << ((3 - level) * mmu_conf.table_idx_bits)
+
+
+def _can_split( mmu_conf, level:int, region ) -> bool:
+    """
+    Table.can_split for a table at this level, see there.
+    """
+    pgt_conf = mmu_conf.pgt_conf
+    large_page = pgt_conf.large_page if region.large_page is None else region.large_page
+    if level >= 3:
+        return False
+    if region.pa % _chunk(mmu_conf, level):
+        return True     # a block's output address must be aligned to its size
+    if large_page == "auto":
+        return level not in mmu_conf.block_levels()
+    can_split_level_min = (1 if pgt_conf.tg_str == "4K" else 2)
+    return (level >= can_split_level_min) and (not large_page)
+
+
+def count_tables( mmu_conf ) -> int:
+    """
+    Number of translation tables Table.gen allocates for the memory map in
+    mmu_conf, computed without building the table tree. A starting level of
+    concatenated tables counts as that many tables, and every address space
+    has a tree of its own.
+
+    A chunk covered completely by a run is never shared with another run, so
+    the tables beneath it are counted arithmetically. Only tables reached
+    through partially covered chunks are collected by (level, va_base), as
+    neighbouring runs may share them.
+    """
+    pgt_conf = mmu_conf.pgt_conf
+    total = 0
+    for extra in [s.regions for s in pgt_conf.address_spaces] or [[]]:
+        shared = set()
+        owned = 0
+        for region in RegionIndex(pgt_conf.regions + extra).runs():
+            owned += _count_range(mmu_conf, mmu_conf.start_level, region, shared)
+        total += mmu_conf.root_tables + len(shared) + owned
+    return total
+
+
+def _count_range( mmu_conf, level:int, region, shared:set ) -> int:
+    """
+    Count the tables region needs beneath a table at this level, adding the
+    ones reached through partially covered chunks to shared and returning
+    the number of the others.
+    """
+    chunk = _chunk(mmu_conf, level)
+    end = region.va + region.size
+    first_full = -(-region.va // chunk)
+    end_full = end // chunk
+    owned = 0
+
+    for c in sorted({region.va // chunk, (end - 1) // chunk}):
+        if first_full <= c < end_full:
+            continue
+        va = max(region.va, c * chunk)
+        shared.add((level + 1, c * chunk))
+        owned += _count_range(mmu_conf, level + 1, region.copy(
+            va=va, pa=region.pa + (va - region.va), size=min(end, (c + 1) * chunk) - va
+        ), shared)
+
+    if end_full > first_full:
+        va = first_full * chunk
+        piece = region.copy(va=va, pa=region.pa + (va - region.va), size=chunk)
+        owned += (end_full - first_full) * _count_subtree(mmu_conf, level, piece)
+    return owned
+
+
+def _count_subtree( mmu_conf, level:int, piece ) -> int:
+    """
+    Number of tables beneath a chunk at this level covered completely by piece.
+    Every sub-chunk splits the same way as output addresses stay aligned alike.
+    """
+    if not _can_split(mmu_conf, level, piece):
+        return 0
+    child = piece.copy(size=_chunk(mmu_conf, level + 1))
+    return 1 + mmu_conf.entries_per_table * _count_subtree(mmu_conf, level + 1, child)
+
+
+def _root_pieces( root, regions ) -> dict:
+    """
+    Map into root the runs of blocks that live in the root table itself and
+    return the rest of regions cut at root chunk boundaries, as a dict of
+    root index to the pieces under that entry, in VA order.
+    """
+    chunk = root.chunk
+    pieces = {}
+    for region in regions:
+        end = region.va + region.size
+        first_full = -(-region.va // chunk)
+        end_full = end // chunk
+        for idx in range(region.va // chunk, (end - 1) // chunk + 1):
+            if first_full <= idx < end_full:
+                continue
+            va = max(region.va, idx * chunk)
+            pieces.setdefault(idx, []).append(region.copy(
+                va=va, pa=region.pa + (va - region.va), size=min(end, (idx + 1) * chunk) - va
+            ))
+        if end_full <= first_full:
+            continue
+        va = first_full * chunk
+        full = region.copy(va=va, pa=region.pa + (va - region.va), size=(end_full - first_full) * chunk)
+        if not root.can_split(full.copy(size=chunk)):
+            root.map(full)
+            continue
+        for idx in range(first_full, end_full):
+            pieces.setdefault(idx, []).append(full.copy(va=idx * chunk, pa=full.pa + (idx - first_full) * chunk, size=chunk))
+    return pieces
+
+
+_worker_mmu_conf = None
+
+
+def _init_worker( pgt_conf ) -> None:
+    global _worker_mmu_conf
+    from .mmu import MmuConfig
+    _worker_mmu_conf = MmuConfig(pgt_conf)
+
+
+def _gen_subtrees( mmu_conf, level:int, tasks:list ) -> list:
+    """
+    Build the level table for each (root index, va_base, pieces) task with
+    its own allocator, returning the tables of each subtree in allocation
+    order, subtree root first.
+    """
+    subtrees = []
+    for idx, va_base, pieces in tasks:
+        allocator = TableAllocator(0, mmu_conf.pgt_conf.tg, mmu_conf.pgt_conf.tg_str)
+        allocator.tracking = False
+        subtree = Table(level, mmu_conf, va_base, allocator)
+        [subtree.map(p) for p in pieces]
+        subtrees.append((idx, allocator.tables))
+    return subtrees
+
+
+def _gen_subtrees_worker( level:int, tasks:list ) -> list:
+    return _gen_subtrees(_worker_mmu_conf, level, tasks)
+
+
+def gen_parallel( level, mmu_conf, jobs:int=None, regions=None, allocator=None ):
+    """
+    Table.gen building the subtree below each root table entry in a pool of
+    jobs worker processes (default: one per CPU).
+
+    Root-level blocks are mapped in this process. Every other run is cut at
+    root chunk boundaries and the pieces below each root entry are mapped
+    into a subtree of their own. Subtrees are then stitched into the root
+    and given addresses in root index order, each keeping its own
+    allocation order. Table addresses therefore depend only on the memory
+    map, not on jobs or on which worker built which subtree, but differ
+    from those of a serial Table.gen. With a single job the subtrees are
+    built in this process, to the same layout.
+    """
+    regions = mmu_conf.pgt_conf.regions if regions is None else regions
+    root = Table(level, mmu_conf, 0, allocator)
+    root.allocator.tracking = False
+    pieces = _root_pieces(root, RegionIndex(regions).runs())
+    tasks = [(idx, idx * root.chunk, pieces[idx]) for idx in sorted(pieces)]
+
+    jobs = min(jobs or os.cpu_count() or 1, max(len(tasks), 1))
+    if jobs == 1:
+        _stitch(root, [_gen_subtrees(mmu_conf, level + 1, tasks)])
+    else:
+        batch = max(1, -(-len(tasks) // (jobs * 4)))
+        batches = [tasks[i:i + batch] for i in range(0, len(tasks), batch)]
+        worker_conf = copy.copy(mmu_conf.pgt_conf)
+        worker_conf.regions = []
+        worker_conf.address_spaces = []
+        logger.debug(f"building {len(tasks)} subtrees in {len(batches)} batches on {jobs} workers")
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(worker_conf,)) as pool:
+            _stitch(root, pool.map(_gen_subtrees_worker, [level + 1] * len(batches), batches))
+    root.allocator.tracking = True
+    return root
+
+
+def _stitch( root, results ) -> None:
+    """
+    Hook each subtree returned by _gen_subtrees into root, allocating its
+    tables from root's allocator in their original order.
+    """
+    for idx, tables in (r for result in results for r in result):
+        for t in tables:
+            t.mmu_conf = root.mmu_conf
+            t.allocator = root.allocator
+            t.addr = root.allocator.alloc(t)
+        root.entries[idx] = tables[0]
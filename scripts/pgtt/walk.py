@@ -0,0 +1,342 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List
+import logging
+import struct
+
+# Optional deps
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Internal deps
+from .mmu import Region
+
+
+DESC_VALID      = 1 << 0
+DESC_TABLE      = 1 << 1        # table (levels 0-2) or page (level 3) descriptor
+DESC_CONTIGUOUS = 1 << 52
+DESC_ATTRS      = 0xf << 2      # AttrIndx and NS (stage 1) or MemAttr (stage 2)
+DESC_NG         = 1 << 11       # not global, stage 1 only
+OA_MASK         = (1 << 48) - 1
+
+
+@dataclass
+class WalkStats:
+    """
+    Class accumulating the cost of the translations made by a Walker.
+    """
+
+    accesses: int = 0            # translations requested
+    tlb_misses: int = 0          # translations that needed a table walk
+    faults: int = 0              # translations that hit an invalid descriptor
+    walk_levels: int = 0         # descriptors read by all table walks
+
+
+    @property
+    def miss_rate( self ) -> float:
+        return self.tlb_misses / self.accesses if self.accesses else 0.0
+
+
+    @property
+    def avg_walk_levels( self ) -> float:
+        """
+        Average number of descriptors read per table walk.
+        """
+        return self.walk_levels / self.tlb_misses if self.tlb_misses else 0.0
+
+
+    def __str__( self ) -> str:
+        return (f"{self.accesses} accesses, {self.tlb_misses} TLB misses ({self.miss_rate:.2%}), "
+                f"{self.faults} faults, {self.avg_walk_levels:.2f} levels per walk")
+
+
+class Tlb:
+    """
+    Class modelling a fully associative TLB with LRU replacement.
+
+    Each entry caches one block, page or Contiguous-hint group and is tagged
+    with the log2 size of the span it covers, so a single lookup probes every
+    span size currently cached.
+    """
+
+    def __init__( self, num_entries:int=64 ):
+        self.num_entries = num_entries
+        self.entries = OrderedDict()
+        self.span_bits = {}         # log2 span size -> number of cached entries
+
+
+    def lookup( self, va:int ):
+        """
+        Return the (pa_base, descriptor, span_bits) cached for va, or None.
+        """
+        for bits in self.span_bits:
+            key = (bits, va >> bits)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        return None
+
+
+    def insert( self, va:int, pa_base:int, descriptor:int, bits:int ) -> None:
+        if not self.num_entries:
+            return
+        key = (bits, va >> bits)
+        if key not in self.entries and len(self.entries) >= self.num_entries:
+            (old_bits, _), _ = self.entries.popitem(last=False)
+            self.span_bits[old_bits] -= 1
+            if not self.span_bits[old_bits]:
+                del self.span_bits[old_bits]
+        if key not in self.entries:
+            self.span_bits[bits] = self.span_bits.get(bits, 0) + 1
+        self.entries[key] = (pa_base, descriptor, bits)
+        self.entries.move_to_end(key)
+
+
+    def flush( self ) -> None:
+        self.entries.clear()
+        self.span_bits.clear()
+
+
+class Walker:
+    """
+    Class simulating stage 1 or stage 2 translation table walks over a table
+    memory image. A stage 2 starting level of concatenated tables is indexed
+    as one larger table.
+
+    The image is the one written by CodeGen._mk_mem or returned by
+    CodeGen.image(): all tables back to back from ttbr, little-endian.
+    """
+
+    def __init__( self, image, mmu_conf, tlb_entries:int=64, root:int=None ):
+        """
+        Constructor.
+
+        args
+        ====
+
+            image
+                        bytes-like table memory image starting at ttbr
+
+            mmu_conf
+                        MmuConfig the image was generated for
+
+            tlb_entries
+                        capacity of the simulated TLB, 0 to disable it
+
+            root
+                        address of the table walks start from, default ttbr;
+                        the root of another address space in the image
+
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.mmu_conf = mmu_conf
+        self.pgt_conf = mmu_conf.pgt_conf
+        self.image = bytes(image)
+        self.root = self.pgt_conf.ttbr if root is None else root
+        self.num_entries = len(self.image) // 8
+        self.tlb = Tlb(tlb_entries)
+        self.stats = WalkStats()
+        self.shifts = {
+            level: self.mmu_conf.block_offset_bits + (3 - level) * self.mmu_conf.table_idx_bits
+            for level in range(self.mmu_conf.start_level, 4)
+        }
+        self.idx_masks = {level: self.mmu_conf.table_idx_mask for level in self.shifts}
+        self.idx_masks[self.mmu_conf.start_level] = self.mmu_conf.entries_per_table * self.mmu_conf.root_tables - 1
+
+
+    @classmethod
+    def from_file( cls, page_mem_file, mmu_conf, tlb_entries:int=64 ):
+        """
+        Load the image written by CodeGen._mk_mem.
+        """
+        with open(page_mem_file, "rb") as page_mem_fd:
+            return cls(page_mem_fd.read(), mmu_conf, tlb_entries)
+
+
+    @classmethod
+    def from_table( cls, table, tlb_entries:int=64 ):
+        """
+        Render the image of an in-memory Table tree and walk that.
+        """
+        from .codegen import CodeGen
+        return cls(CodeGen(table).image(), table.mmu_conf, tlb_entries)
+
+
+    def _descriptor( self, table_addr:int, idx:int ) -> int:
+        offset = (table_addr - self.pgt_conf.ttbr) // 8 + idx
+        if not 0 <= offset < self.num_entries:
+            raise ValueError(f"descriptor at {hex(table_addr + idx * 8)} lies outside the table image")
+        return struct.unpack_from("<Q", self.image, offset * 8)[0]
+
+
+    def walk( self, va:int ):
+        """
+        Walk the tables for va, bypassing the TLB.
+
+        Returns (pa, descriptor, levels, span_bits) where levels is the number
+        of descriptors read and span_bits the log2 size of the memory the
+        final descriptor translates, or (None, 0, levels, 0) on a fault.
+        """
+        if va >> self.pgt_conf.tsz:
+            return None, 0, 0, 0
+        table = self.root
+        for level in range(self.mmu_conf.start_level, 4):
+            shift = self.shifts[level]
+            d = self._descriptor(table, (va >> shift) & self.idx_masks[level])
+            levels = level - self.mmu_conf.start_level + 1
+            if not d & DESC_VALID:
+                return None, 0, levels, 0
+            if level < 3 and d & DESC_TABLE:
+                table = d & OA_MASK & ~(self.pgt_conf.tg - 1)
+                continue
+            if level == 3 and not d & DESC_TABLE:
+                return None, 0, levels, 0
+            bits = shift
+            if d & DESC_CONTIGUOUS:
+                bits += (self.mmu_conf.contig_entries(level) - 1).bit_length()
+            pa = (d & OA_MASK & ~((1 << shift) - 1)) | (va & ((1 << shift) - 1))
+            return pa, d, levels, bits
+
+
+    def translate( self, va:int ):
+        """
+        Translate va through the TLB, walking the tables on a miss.
+        Returns the output address, or None on a translation fault.
+        """
+        self.stats.accesses += 1
+        hit = self.tlb.lookup(va)
+        if hit is not None:
+            pa_base, _, bits = hit
+            return pa_base | (va & ((1 << bits) - 1))
+
+        self.stats.tlb_misses += 1
+        pa, d, levels, bits = self.walk(va)
+        self.stats.walk_levels += levels
+        if pa is None:
+            self.stats.faults += 1
+            return None
+        self.tlb.insert(va, pa & ~((1 << bits) - 1), d, bits)
+        return pa
+
+
+    def translate_many( self, vas ):
+        """
+        Translate an array of virtual addresses in bulk, bypassing the TLB.
+
+        Returns (pa, valid, levels, span_bits) arrays, one entry per va; pa is
+        0 wherever valid is False. Uses numpy when available, otherwise a list
+        of walk() results is transposed into lists.
+        """
+        if numpy is None:
+            results = [self.walk(va) for va in vas]
+            return (
+                [r[0] or 0 for r in results],
+                [r[0] is not None for r in results],
+                [r[2] for r in results],
+                [r[3] for r in results],
+            )
+
+        image = numpy.frombuffer(self.image, dtype="<u8", count=self.num_entries)
+        vas = numpy.asarray(vas, dtype=numpy.uint64)
+        ttbr = numpy.uint64(self.pgt_conf.ttbr)
+        pa = numpy.zeros(vas.shape, dtype=numpy.uint64)
+        span_bits = numpy.zeros(vas.shape, dtype=numpy.uint8)
+        levels = numpy.zeros(vas.shape, dtype=numpy.uint8)
+        valid = numpy.zeros(vas.shape, dtype=bool)
+        table = numpy.full(vas.shape, self.root, dtype=numpy.uint64)
+        active = (vas >> numpy.uint64(self.pgt_conf.tsz)) == 0
+
+        for level in range(self.mmu_conf.start_level, 4):
+            if not active.any():
+                break
+            shift = numpy.uint64(self.shifts[level])
+            idx = (vas[active] >> shift) & numpy.uint64(self.idx_masks[level])
+            offset = (table[active] - ttbr) // numpy.uint64(8) + idx
+            if (offset >= self.num_entries).any():
+                raise ValueError("descriptor lies outside the table image")
+            d = image[offset]
+            levels[active] += 1
+
+            is_valid = (d & numpy.uint64(DESC_VALID)) != 0
+            has_bit1 = (d & numpy.uint64(DESC_TABLE)) != 0
+            is_table = is_valid & has_bit1 if level < 3 else numpy.zeros(d.shape, dtype=bool)
+            is_leaf = is_valid & (~has_bit1 if level < 3 else has_bit1)
+
+            where = numpy.flatnonzero(active)
+            leaf = where[is_leaf]
+            offset_mask = numpy.uint64((1 << self.shifts[level]) - 1)
+            pa[leaf] = (d[is_leaf] & numpy.uint64(OA_MASK) & ~offset_mask) | (vas[leaf] & offset_mask)
+            contig = (d[is_leaf] & numpy.uint64(DESC_CONTIGUOUS)) != 0
+            span_bits[leaf] = self.shifts[level] + contig * (self.mmu_conf.contig_entries(level) - 1).bit_length()
+            valid[leaf] = True
+
+            table[where[is_table]] = d[is_table] & numpy.uint64(OA_MASK & ~(self.pgt_conf.tg - 1))
+            active[where[~is_table]] = False
+
+        return pa, valid, levels, span_bits
+
+
+    def simulate( self, trace ) -> WalkStats:
+        """
+        Run an access trace through the TLB model and return its statistics.
+
+        The walks themselves are done in bulk by translate_many; only the LRU
+        bookkeeping is replayed access by access. Statistics accumulate into
+        self.stats across calls, the returned WalkStats covers this trace only.
+        """
+        pa, valid, levels, span_bits = self.translate_many(trace)
+        stats = WalkStats()
+        tlb = self.tlb
+        for va, ok, n, bits in zip(trace, valid, levels, span_bits):
+            va, bits = int(va), int(bits)
+            stats.accesses += 1
+            if ok and tlb.lookup(va) is not None:
+                continue
+            stats.tlb_misses += 1
+            stats.walk_levels += int(n)
+            if not ok:
+                stats.faults += 1
+                continue
+            tlb.insert(va, 0, 0, bits)
+
+        for field in ("accesses", "tlb_misses", "faults", "walk_levels"):
+            setattr(self.stats, field, getattr(self.stats, field) + getattr(stats, field))
+        return stats
+
+
+    def verify( self, regions:List[Region], step:int=None ) -> List[tuple]:
+        """
+        Check that every step bytes (default: one granule) of each region
+        translates to the expected output address and memory attributes.
+
+        Returns a list of (region, va, pa) mismatches, pa being None for a
+        translation fault.
+        """
+        step = step or self.pgt_conf.tg
+        mismatches = []
+        for region in regions:
+            vas = list(range(region.va, region.va + region.size, step))
+            pa, valid, _, _ = self.translate_many(vas)
+            for i, va in enumerate(vas):
+                expected = region.pa + (va - region.va)
+                if not valid[i]:
+                    mismatches.append((region, va, None))
+                elif int(pa[i]) != expected:
+                    mismatches.append((region, va, int(pa[i])))
+            for i in (0, len(vas) - 1) if vas else ():
+                _, d, _, _ = self.walk(vas[i])
+                expected = self.mmu_conf.entry_template_value(region.mem_type, region.mem_attr, False, False, region.non_global)
+                if d and (d ^ expected) & (DESC_ATTRS | DESC_NG):
+                    mismatches.append((region, vas[i], int(pa[i])))
+        self.logger.debug(f"{len(mismatches)} mismatches over {len(regions)} regions")
+        return mismatches
@@ -0,0 +1,38 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Optional deps
+import pytest
+
+# Internal deps
+from config import PgtConfig
+
+
+@pytest.fixture
+def make_pgt_conf():
+    """
+    Build a PgtConfig from maps in config.json form, with the mandatory
+    pagetable options defaulted and any others given as keyword arguments.
+    """
+    def make_pgt_conf( maps, granule="4K", tsz=32, **options ):
+        pgt = {
+            "gen_table_runtime" : True,
+            "excepiton_level"   : 1,
+            "table_base_addr"   : "0x80000000",
+            "granule"           : granule,
+            "table_region_size" : tsz,
+            "large_page"        : False,
+            "maps"              : maps,
+        }
+        pgt.update(options)
+        return PgtConfig(pgt)
+    return make_pgt_conf
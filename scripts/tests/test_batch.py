@@ -0,0 +1,23 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+import io
+
+# Internal deps
+from pgtt.batch import generate, stream_all
+
+
+def test_stream_matches_generate( make_pgt_conf ):
+    ram = {"va": "0x40000000", "pa": "0x40000000", "size": "3M", "type": "NORMAL", "attr": "wxs", "description": "RAM"}
+    pgt_confs = [make_pgt_conf([ram]), make_pgt_conf([ram], "16K", 36, large_page=True)]
+    expected = "".join(
+        f"{a.dump}\n{a.usage}\n{a.asm}\n" for a in map(generate, pgt_confs)
+    )
+    for jobs in (1, 2):
+        out = io.StringIO()
+        stream_all(pgt_confs, out, jobs)
+        assert out.getvalue() == expected
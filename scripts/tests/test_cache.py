@@ -0,0 +1,38 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Internal deps
+from pgtt.batch import generate_all
+import pgtt.cache
+from pgtt.cache import ArtifactCache
+
+
+def test_num_tables_of_concatenated_root( make_pgt_conf, tmp_path ):
+    high = {"va": "0xff00000000", "pa": "0x80000000", "size": "2M", "type": "NORMAL", "attr": "wxs", "description": "HIGH"}
+    pgt_conf = make_pgt_conf([high], tsz=40, excepiton_level=2, stage=2)
+    cache = ArtifactCache(str(tmp_path))
+    generated, = generate_all([pgt_conf], 1, cache)
+    cached, = generate_all([pgt_conf], 1, cache)
+    assert cached == generated
+    assert cached.num_tables != len(cached.image) // pgt_conf.tg
+
+
+def test_key_depends_on_address_spaces( make_pgt_conf ):
+    ram = {"va": "0x40000000", "pa": "0x40000000", "size": "2M", "type": "NORMAL", "attr": "wxs", "description": "RAM"}
+    keys = set()
+    for _ in range(2):
+        pgt_conf = make_pgt_conf([], address_spaces=[{"asid": 1, "description": "task1", "maps": [ram]}])
+        keys.add(ArtifactCache.key(pgt_conf))
+    assert len(keys) == 1
+    pgt_conf = make_pgt_conf([], address_spaces=[{"asid": 1, "description": "task1", "maps": [dict(ram, pa="0x40200000")]}])
+    assert ArtifactCache.key(pgt_conf) not in keys
+
+
+def test_key_depends_on_version( make_pgt_conf, monkeypatch ):
+    pgt_conf = make_pgt_conf([])
+    key = ArtifactCache.key(pgt_conf)
+    monkeypatch.setattr(pgtt.cache, "__version__", "0.0.0")
+    assert ArtifactCache.key(pgt_conf) != key
@@ -0,0 +1,110 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+import errno
+import json
+
+# Optional deps
+import pytest
+
+# Internal deps
+from config import Config, ConfigError, PgtConfig, main, strip_comments
+
+
+def _pgt( **options ):
+    pgt = {
+        "gen_table_runtime" : True,
+        "excepiton_level"   : 1,
+        "table_base_addr"   : "0x80000000",
+        "granule"           : "4K",
+        "table_region_size" : 32,
+        "large_page"        : True,
+        "maps"              : [
+            {"va": "0x0", "pa": "0x10000000", "size": "4K", "type": "DEVICE_nGnRE", "attr": "wxs", "description": "UART0"},
+        ],
+    }
+    pgt.update(options)
+    return pgt
+
+
+@pytest.mark.parametrize("option, value", [
+    ("runtime_fill", "stanza"),
+    ("zero_tables", "some"),
+    ("zero_tables", False),
+    ("large_page", "yes"),
+    ("large_page", 1),
+    ("contiguous_hint", "false"),
+    ("dedupe_tables", 1),
+    ("gen_table_runtime", "false"),
+    ("table_image", 5),
+    ("maps_file", 5),
+])
+def test_bad_option_value( option, value ):
+    with pytest.raises(ConfigError, match=f"pagetables\\[0\\]: {option} "):
+        PgtConfig(_pgt(**{option: value}), "pagetables[0]")
+
+
+def test_bad_map_large_page():
+    pgt = _pgt()
+    pgt["maps"][0]["large_page"] = "no"
+    with pytest.raises(ConfigError, match="maps\\[0\\] .*: large_page 'no'"):
+        PgtConfig(pgt)
+
+
+def test_map_beyond_table_region_size():
+    pgt = _pgt()
+    pgt["maps"][0]["va"] = "0x100000000"
+    with pytest.raises(ConfigError, match="maps\\[0\\] .*: 0x100000000-0x100000fff is beyond table_region_size 32"):
+        PgtConfig(pgt)
+
+
+def test_good_option_values():
+    pgt = _pgt(runtime_fill="table", zero_tables="sparse", large_page="auto", contiguous_hint=True, dedupe_tables=True)
+    pgt["maps"][0]["large_page"] = False
+    pgt_conf = PgtConfig(pgt)
+    assert pgt_conf.large_page == "auto"
+    assert pgt_conf.regions[0].large_page is False
+
+
+@pytest.mark.parametrize("command", ["count", "gen"])
+def test_overlapping_maps_cli( command, tmp_path, caplog ):
+    pgt = _pgt()
+    pgt["maps"].append(dict(pgt["maps"][0], pa="0x20000000", description="UART1"))
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"pagetables": [pgt]}))
+    assert main([command, "-c", str(config_file), "--no-cache"]) == errno.EINVAL
+    assert "pagetables[0].maps: region 'UART1' 0x0-0xfff overlaps region 'UART0'" in caplog.text
+
+
+def test_gen_output_starts_with_dump( tmp_path, capsys ):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"pagetables": [_pgt()]}))
+    assert main(["gen", "-c", str(config_file), "--no-cache"]) == 0
+    out = capsys.readouterr().out
+    assert out.startswith("        level 1 table @ 0x80000000\n")
+    assert "PgtConfig object" not in out
+
+
+def test_strip_trailing_comment():
+    assert json.loads(strip_comments('{"a": 1, // one\n "b": 2} // end')) == {"a": 1, "b": 2}
+
+
+def test_strip_keeps_markers_in_strings():
+    text = '{"url": "https://example.com/*x*/", "c": "/* not */ // either"} // gone\n'
+    assert json.loads(strip_comments(text)) == {"url": "https://example.com/*x*/", "c": "/* not */ // either"}
+
+
+def test_strip_escaped_quotes():
+    text = r'{"q": "say \"hi\" // still a string", "p": "a\\"} // comment "with quote' + "\n"
+    assert json.loads(strip_comments(text)) == {"q": 'say "hi" // still a string', "p": "a\\"}
+
+
+def test_strip_block_comment_keeps_line_numbers( tmp_path ):
+    config_file = tmp_path / "config.json"
+    config_file.write_text('{\n/* one\n   two\n   three */ "pagetables":\n  [,]\n}\n')
+    with pytest.raises(ConfigError, match=r"config.json:5:4: "):
+        Config(str(config_file))
@@ -0,0 +1,81 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+import random
+
+# Optional deps
+import pytest
+
+# Internal deps
+from pgtt.mmu import MmuConfig
+from pgtt.table import Table, count_tables
+
+
+GRANULES = {"4K": 4 * 1024, "16K": 16 * 1024, "64K": 64 * 1024}
+
+
+def _maps( tg_str, tsz, seed, num_maps=40 ):
+    """
+    Windows of a few pages up to a few blocks, at random granule-aligned
+    offsets in evenly spaced slots of the input address space.
+    """
+    tg = GRANULES[tg_str]
+    rand = random.Random(seed)
+    stride = (1 << tsz) // num_maps // tg * tg
+    maps = []
+    for i in range(num_maps):
+        pages = rand.choice((1, 3, 16, 600, 2048, 9000))
+        pages = min(pages, stride // tg // 2)
+        va = i * stride + rand.randrange(0, stride // 2, tg)
+        maps.append({
+            "va": hex(va),
+            "pa": hex(va + (1 << 30) + rand.choice((0, tg))),
+            "size": f"{pages * tg // 1024}K",
+            "type": "NORMAL",
+            "attr": "wxs",
+            "description": f"WIN{i}",
+            "large_page": rand.choice((None, None, True, False, "auto")),
+        })
+    for m in maps:
+        if m["large_page"] is None:
+            del m["large_page"]
+    return maps
+
+
+def _granules( pgt_conf ) -> int:
+    mmu_conf = MmuConfig(pgt_conf)
+    if pgt_conf.address_spaces:
+        roots = Table.gen_spaces(mmu_conf.start_level, mmu_conf)
+        return roots[0].allocator.granules
+    return Table.gen(mmu_conf.start_level, mmu_conf).allocator.granules
+
+
+@pytest.mark.parametrize("tg_str", GRANULES)
+@pytest.mark.parametrize("large_page", [True, False, "auto"])
+@pytest.mark.parametrize("tsz", [32, 40])
+def test_count_matches_gen( make_pgt_conf, tg_str, large_page, tsz ):
+    for seed in range(3):
+        pgt_conf = make_pgt_conf(_maps(tg_str, tsz, seed), tg_str, tsz, large_page=large_page)
+        assert count_tables(MmuConfig(pgt_conf)) == _granules(pgt_conf)
+
+
+@pytest.mark.parametrize("tg_str, tsz", [("4K", 32), ("4K", 40), ("16K", 40), ("16K", 48), ("64K", 32)])
+def test_count_matches_gen_stage2( make_pgt_conf, tg_str, tsz ):
+    pgt_conf = make_pgt_conf(_maps(tg_str, tsz, 0), tg_str, tsz, large_page="auto", excepiton_level=2, stage=2)
+    mmu_conf = MmuConfig(pgt_conf)
+    assert mmu_conf.root_tables > 1
+    assert count_tables(mmu_conf) == _granules(pgt_conf)
+
+
+def test_count_matches_gen_address_spaces( make_pgt_conf ):
+    maps = _maps("4K", 32, 0)
+    spaces = [
+        {"asid": 1, "description": "task1", "maps": [dict(m, va=hex(int(m["va"], 16) + 4096)) for m in maps[1::4]]},
+        {"asid": 2, "description": "task2", "maps": []},
+    ]
+    pgt_conf = make_pgt_conf(maps[::4], large_page="auto", address_spaces=spaces)
+    assert count_tables(MmuConfig(pgt_conf)) == _granules(pgt_conf)
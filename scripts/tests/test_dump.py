@@ -0,0 +1,27 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Internal deps
+from pgtt.mmu import MmuConfig
+from pgtt.table import Table
+
+
+def test_dump_shared_table_at_each_parent_va( make_pgt_conf ):
+    maps = [
+        {"va": "0x0", "pa": "0x10000000", "size": "8K", "type": "NORMAL", "attr": "wxs", "description": "alias0"},
+        {"va": "0x40000000", "pa": "0x10000000", "size": "8K", "type": "NORMAL", "attr": "wxs", "description": "alias1"},
+    ]
+    mmu_conf = MmuConfig(make_pgt_conf(maps))
+    table = Table.gen(mmu_conf.start_level, mmu_conf)
+    assert table.dedupe() == 2
+
+    lines = str(table).splitlines()
+    assert " 0x000040000000-0x000040000fff, " in lines[-2]
+    assert " 0x000040001000-0x000040001fff, " in lines[-1]
+    # the second subtree is reached through a table first allocated for VA 0x0
+    shared = [line for line in lines if "shared with 0x0)" in line]
+    assert len(shared) == 2
+    assert lines.index(shared[0]) > len(lines) // 2
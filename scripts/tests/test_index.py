@@ -0,0 +1,58 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Optional deps
+import pytest
+
+# Internal deps
+from pgtt.index import RegionIndex
+from pgtt.mmu import MemAttr, Region
+
+
+K = 1024
+RW = MemAttr(1, 0, 0)
+RO = MemAttr(3, 0, 0)
+
+
+def _runs( regions ):
+    return [(r.va, r.size) for r in RegionIndex(regions).runs()]
+
+
+def test_adjacent_compatible_regions_merge():
+    a = Region(0, "A", 0x10000, 0x90000, 8 * K, "NORMAL", RW)
+    b = Region(0, "B", 0x12000, 0x92000, 4 * K, "NORMAL", RW)
+    assert _runs([b, a]) == [(0x10000, 12 * K)]
+
+
+def test_overlapping_same_offset_regions_merge():
+    a = Region(0, "A", 0x10000, 0x90000, 16 * K, "NORMAL", RW)
+    b = Region(0, "B", 0x12000, 0x92000, 4 * K, "NORMAL", RW)
+    c = Region(0, "C", 0x1c000, 0x9c000, 8 * K, "NORMAL", RW)
+    assert _runs([a, b, c]) == [(0x10000, 16 * K), (0x1c000, 8 * K)]
+    d = Region(0, "D", 0x13000, 0x93000, 40 * K, "NORMAL", RW)
+    assert _runs([a, b, c, d]) == [(0x10000, 56 * K)]
+
+
+@pytest.mark.parametrize("b", [
+    Region(0, "B", 0x12000, 0x52000, 8 * K, "NORMAL", RW),          # other output address
+    Region(0, "B", 0x12000, 0x92000, 8 * K, "NORMAL", RO),          # other attributes
+    Region(0, "B", 0x12000, 0x92000, 8 * K, "DEVICE_nGnRE", RW),    # other memory type
+])
+def test_incompatible_overlap_raises( b ):
+    a = Region(0, "A", 0x10000, 0x90000, 16 * K, "NORMAL", RW)
+    with pytest.raises(ValueError, match="region 'B' 0x12000-0x13fff overlaps region 'A' 0x10000-0x13fff"):
+        RegionIndex([a, b])
+
+
+def test_adjacent_incompatible_regions_stay_separate():
+    a = Region(0, "A", 0x10000, 0x90000, 8 * K, "NORMAL", RW)
+    b = Region(0, "B", 0x12000, 0x92000, 8 * K, "NORMAL", RO)
+    c = Region(0, "C", 0x14000, 0x20000, 8 * K, "NORMAL", RO)
+    index = RegionIndex([c, a, b])
+    assert [(r.label, r.va, r.size) for r in index.runs()] == [
+        ("A", 0x10000, 8 * K), ("B", 0x12000, 8 * K), ("C", 0x14000, 8 * K),
+    ]
+    assert (len(index), index.num_regions) == (3, 3)
@@ -0,0 +1,89 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Optional deps
+import pytest
+
+# Internal deps
+from pgtt import mapfile
+from pgtt.mapfile import MAGIC, RECORD, read_binary, read_csv, write_binary
+from pgtt.mmu import MemAttr, Region
+
+
+K = 1024
+
+
+def _fields( regions ):
+    return [(r.va, r.pa, r.size, r.mem_type, r.mem_attr, r.large_page) for r in regions]
+
+
+@pytest.fixture(params=["numpy", "struct"])
+def decoder( request, monkeypatch ):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(mapfile, "numpy", None)
+    return request.param
+
+
+def test_binary_round_trip( decoder, tmp_path ):
+    regions = [
+        Region(0, "A", 0x0, 0x10000000, 4 * K, "DEVICE_nGnRE", MemAttr(0b01, 0, 0), None),
+        Region(0, "B", 0x40000000, 0x40000000, 2048 * K, "NORMAL", MemAttr(0b11, 1, 1), True),
+        Region(0, "C", 0x80000000, 0x0, 8 * K, "NORMAL", MemAttr(0b01, 1, 0), "auto"),
+        Region(0, "D", 0x90000000, 0x0, 4 * K, "DEVICE_nGnRnE", MemAttr(0b11, 0, 1), False),
+    ]
+    path = tmp_path / "map.bin"
+    write_binary(str(path), regions)
+    read = read_binary(str(path), 4 * K)
+    assert _fields(read) == _fields(regions)
+    assert [r.label for r in read] == [f"map.bin[{i}]" for i in range(4)]
+    write_binary(str(path), [])
+    assert read_binary(str(path), 4 * K) == []
+
+
+def test_binary_errors( decoder, tmp_path ):
+    path = tmp_path / "map.bin"
+    record = RECORD.pack(0, 0, 4 * K, 0, 0, 0)
+    path.write_bytes(b"PGTMAP\x00\x02" + record)
+    with pytest.raises(ValueError, match="bad magic"):
+        read_binary(str(path), 4 * K)
+    path.write_bytes(MAGIC + record + record[:-1])
+    with pytest.raises(ValueError, match=f"truncated record at offset {len(MAGIC) + RECORD.size}"):
+        read_binary(str(path), 4 * K)
+    for field, bad in (("type", RECORD.pack(0, 0, 4 * K, 200, 0, 0)),
+                       ("attr", RECORD.pack(0, 0, 4 * K, 0, 8, 0)),
+                       ("large_page", RECORD.pack(0, 0, 4 * K, 0, 0, 4))):
+        path.write_bytes(MAGIC + record + bad)
+        with pytest.raises(ValueError, match=f"record 1: invalid {field}"):
+            read_binary(str(path), 4 * K)
+
+
+def test_csv_sizes( tmp_path ):
+    path = tmp_path / "map.csv"
+    path.write_text("va,pa,size,type,attr\n0x0,0x0,4096,NORMAL,wxs\n0x100000,0x0,2M,NORMAL,wxs\n0x400000,0x0,0x1000,0,0\n")
+    assert [r.size for r in read_csv(str(path), 4096)] == [4096, 2 * 1024 * 1024, 4096]
+
+
+def test_csv_columns( tmp_path ):
+    path = tmp_path / "map.csv"
+    path.write_text("va,pa,size,type,attr,large_page,description\n0x1000,0x2000,1K,DEVICE_nGnRE,!w!xs,Auto,UART\n")
+    region, = read_csv(str(path), 4 * K)
+    assert (region.lineno, region.label, region.va, region.size, region.mem_type, region.large_page) == \
+           (2, "UART", 0x1000, 4 * K, "DEVICE_nGnRE", "auto")
+    assert region.mem_attr == MemAttr(0b11, 1, 0)
+
+    path.write_text("va,size,attr\n0x0,4K,wxs\n")
+    with pytest.raises(ValueError, match="map.csv:1: missing column\\(s\\) pa, type"):
+        read_csv(str(path), 4 * K)
+    for row, error in (("0x0,,4K,NORMAL,wxs", "map.csv:2: missing pa"),
+                       ("0x0,0x0,4Q,NORMAL,wxs", "map.csv:2: invalid size '4Q'"),
+                       ("0x0,0x0,4K,SLOW,wxs", "map.csv:2: invalid type 'SLOW'"),
+                       ("0x0,0x0,4K,NORMAL,rw", "map.csv:2: invalid attr 'rw'"),
+                       ("0x0,0x0,4K,NORMAL,wxs,maybe", "map.csv:2: invalid large_page 'maybe'")):
+        path.write_text(f"va,pa,size,type,attr,large_page\n{row}\n")
+        with pytest.raises(ValueError, match=error):
+            read_csv(str(path), 4 * K)
@@ -0,0 +1,61 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+import pickle
+
+# Optional deps
+import pytest
+
+# Internal deps
+from pgtt.codegen import CodeGen
+from pgtt.mmu import MmuConfig
+from pgtt.table import Run, Table, gen_parallel
+from pgtt.walk import Walker
+
+
+def _maps( num_maps ):
+    # a page, a misaligned run and a 2MB block below each of num_maps 1GB root entries
+    maps = []
+    for i in range(num_maps):
+        base = i << 30
+        maps += [
+            {"va": hex(base), "pa": hex(base + 0x1000), "size": "4K", "type": "DEVICE_nGnRE", "attr": "wxs", "description": f"DEV{i}"},
+            {"va": hex(base + 0x301000), "pa": hex(base + 0x301000), "size": "2100K", "type": "NORMAL", "attr": "wxs", "description": f"RAM{i}"},
+            {"va": hex(base + 0x800000), "pa": hex(base + 0x800000), "size": "2M", "type": "NORMAL", "attr": "!wxs", "description": f"RO{i}"},
+        ]
+    return maps
+
+
+def test_pickle_round_trip( make_pgt_conf ):
+    mmu_conf = MmuConfig(make_pgt_conf(_maps(1), large_page=True))
+    table = Table.gen(mmu_conf.start_level, mmu_conf)
+    subtree = table.entries[0]
+    copy = pickle.loads(pickle.dumps(subtree))
+    assert (copy.level, copy.chunk, copy.va_base) == (subtree.level, subtree.chunk, subtree.va_base)
+    assert copy.entries.keys() == subtree.entries.keys()
+    run = next(e for e in subtree.entries.values() if type(e) is Run)
+    run_copy = pickle.loads(pickle.dumps(run))
+    assert (run_copy.pa, run_copy.num_contig, run_copy.label, run_copy.is_page, run_copy.contiguous) == \
+           (run.pa, run.num_contig, run.label, run.is_page, run.contiguous)
+
+
+@pytest.mark.parametrize("large_page", [True, False])
+def test_parallel_matches_serial( make_pgt_conf, large_page ):
+    pgt_conf = make_pgt_conf(_maps(3), large_page=large_page)
+    mmu_conf = MmuConfig(pgt_conf)
+    serial = Table.gen(mmu_conf.start_level, mmu_conf, 1)
+
+    images = []
+    for jobs in (2, 3):
+        table = Table.gen(mmu_conf.start_level, mmu_conf, jobs)
+        assert len(table.allocator) == len(serial.allocator)
+        assert Walker.from_table(table).verify(pgt_conf.regions) == []
+        images.append(CodeGen(table).image())
+    images.append(CodeGen(gen_parallel(mmu_conf.start_level, mmu_conf, 1)).image())
+    # table layout depends on the memory map only, not on the number of jobs
+    assert images[0] == images[1] == images[2]
+    assert len(images[0]) == len(CodeGen(serial).image())
@@ -0,0 +1,49 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+from struct import pack_into
+
+# Internal deps
+from pgtt.codegen import CodeGen
+from pgtt.mmu import MemAttr, MmuConfig, Region
+from pgtt.table import Table
+
+
+K = 1024
+
+
+def test_patch_clears_new_tables_over_dirty_memory( make_pgt_conf ):
+    ram = {"va": "0x40000000", "pa": "0x40000000", "size": "4M", "type": "NORMAL", "attr": "wxs", "description": "RAM"}
+    mmu_conf = MmuConfig(make_pgt_conf([ram], large_page=True))
+    table = Table.gen(mmu_conf.start_level, mmu_conf)
+    coder = CodeGen(table)
+    image = bytearray(coder.image())
+    num_tables = len(table.allocator)
+
+    table.map(Region(0, "DEV", 0x9000000, 0x9000000, 8 * K, "DEVICE_nGnRE", MemAttr(1, 0, 0)))
+    assert len(table.allocator) > num_tables
+
+    # tables beyond those mmu_on cleared start out as garbage, valid bits set
+    image.extend(b"\xff" * (table.allocator.size() - len(image)))
+    for addr, value in coder.patches():
+        pack_into("<Q", image, addr - table.pgt_conf.ttbr, value)
+    assert image == coder.image()
+
+
+def test_patch_orders_levels_with_barrier( make_pgt_conf ):
+    ram = {"va": "0x40000000", "pa": "0x40000000", "size": "4M", "type": "NORMAL", "attr": "wxs", "description": "RAM"}
+    mmu_conf = MmuConfig(make_pgt_conf([ram], large_page=True))
+    table = Table.gen(mmu_conf.start_level, mmu_conf)
+    coder = CodeGen(table)
+    table.map(Region(0, "DEV", 0x9000000, 0x9000000, 8 * K, "DEVICE_nGnRE", MemAttr(1, 0, 0)))
+
+    # new level 3 and level 2 tables, then the level 1 entry pointing to them
+    levels = coder._patch_levels()
+    assert len(levels) == 3
+    patch = coder.gen_patch()
+    assert patch.count(".8byte  0, 0") == len(levels) - 1
+    assert "DSB     ISHST                    // deeper level complete" in patch
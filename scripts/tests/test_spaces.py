@@ -0,0 +1,61 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Standard Python deps
+import re
+
+# Optional deps
+import pytest
+
+# Internal deps
+from pgtt.codegen import CodeGen
+from pgtt.mmu import MmuConfig
+from pgtt.table import Table
+from pgtt.walk import Walker
+
+
+DESC_NG = 1 << 11
+
+
+def _map( label, va, pa, size="8K" ):
+    return {"va": hex(va), "pa": hex(pa), "size": size, "type": "NORMAL", "attr": "wxs", "description": label}
+
+
+@pytest.mark.parametrize("dedupe", [False, True])
+def test_address_spaces( make_pgt_conf, dedupe ):
+    spaces = [
+        {"asid": 5, "description": "task1", "maps": [_map("T1", 0x60000000, 0x1000000), _map("SHARED", 0x70000000, 0x3000000)]},
+        {"asid": 9, "description": "task2", "maps": [_map("T2", 0x60200000, 0x2000000), _map("SHARED", 0x70000000, 0x3000000)]},
+        {"asid": 200, "description": "idle", "maps": []},
+    ]
+    kernel = [_map("KERNEL", 0x40000000, 0x40000000, "2M"), _map("UART", 0x9000000, 0x9000000, "4K")]
+    pgt_conf = make_pgt_conf(kernel, large_page="auto", address_spaces=spaces, dedupe_tables=dedupe)
+    mmu_conf = MmuConfig(pgt_conf)
+    roots = Table.gen_spaces(mmu_conf.start_level, mmu_conf)
+    if dedupe:
+        assert roots[0].dedupe() > 0
+    coder = CodeGen(roots[0], roots)
+    image = coder.image()
+
+    for space, root in zip(pgt_conf.address_spaces, roots):
+        walker = Walker(image, mmu_conf, root=root.addr)
+        # global maps translate in every space, without nG
+        assert walker.verify(pgt_conf.regions) == []
+        assert all(not walker.walk(r.va)[1] & DESC_NG for r in pgt_conf.regions)
+        # the space's own maps translate with nG, those of other spaces fault
+        assert walker.verify(space.regions) == []
+        assert all(walker.walk(r.va)[1] & DESC_NG for r in space.regions)
+        for other in pgt_conf.address_spaces:
+            for r in other.regions:
+                if not any(s.va == r.va for s in space.regions):
+                    assert walker.walk(r.va)[0] is None
+
+    # mmu_spaces holds root | ASID << 48 for each space in order, and mmu_on starts in the first
+    asm = coder.gen(None)
+    table = asm[asm.index("mmu_spaces:"):asm.index(".section .text.mmu_switch")]
+    expected = [root.addr | space.asid << 48 for space, root in zip(pgt_conf.address_spaces, roots)]
+    assert [int(v, 16) for v in re.findall(r"\.8byte\s+(0x[0-9a-f]+)", table)] == expected
+    assert f"LDR     x1, ={expected[0]}" in asm
@@ -0,0 +1,35 @@
+"""
+Copyright (c) 2019 Ash Wilding. All rights reserved.
+
+SPDX-License-Identifier: MIT
+"""
+
+# Internal deps
+from pgtt.codegen import CodeGen
+from pgtt.mmu import MemAttr, MmuConfig, Region
+from pgtt.table import Table
+from pgtt.walk import Walker
+
+
+def _stage2( make_pgt_conf, maps, granule="4K", tsz=40 ):
+    pgt_conf = make_pgt_conf(maps, granule, tsz, excepiton_level=2, stage=2)
+    mmu_conf = MmuConfig(pgt_conf)
+    return Table.gen(mmu_conf.start_level, mmu_conf)
+
+
+def test_concatenated_root( make_pgt_conf ):
+    high = {"va": "0xff00000000", "pa": "0x80000000", "size": "2M", "type": "NORMAL", "attr": "wxs", "description": "HIGH"}
+    table = _stage2(make_pgt_conf, [high])
+    assert (table.level, table.granules) == (1, 2)
+    assert table.allocator.size() == (2 + 2) * 4096
+    assert Walker.from_table(table).verify(table.pgt_conf.regions) == []
+
+
+def test_patch_invalidates_stage2_tlb( make_pgt_conf ):
+    ram = {"va": "0x40000000", "pa": "0x40000000", "size": "2M", "type": "NORMAL", "attr": "wxs", "description": "RAM"}
+    table = _stage2(make_pgt_conf, [ram])
+    coder = CodeGen(table)
+    table.map(Region(0, "DEV", 0x9000000, 0x9000000, 4096, "DEVICE_nGnRE", MemAttr(1, 0, 0)))
+    patch = coder.gen_patch()
+    assert "TLBI    VMALLS12E1IS" in patch
+    assert "ALLE2IS" not in patch